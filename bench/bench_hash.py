@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    Micro-benchmark of file hashing engines.
+    Creates (or reuses) a file of given size and hashes it with every engine from hasher module.
+    Note that engines which drop pages from cache are measured against a cold cache on their next run,
+    so use a file larger than RAM or run as root with --drop-caches to compare engines fairly.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+import hasher
+from common import bytes_to_human
+from synthetic import drop_caches
+
+CHUNK_SIZE = 2 ** 24
+
+def create_file(path, size):
+    with open(path, 'wb') as fobj:
+        left = size
+        while left > 0:
+            chunk = min(CHUNK_SIZE, left)
+            fobj.write(os.urandom(chunk))
+            left -= chunk
+
+def main():
+    oparser = optparse.OptionParser(usage='%prog [options] [file]', description=__doc__.strip())
+    oparser.add_option('-s', '--size', type='int', default=2048,
+        help='size of generated file in MiB (%default)')
+    oparser.add_option('-r', '--repeat', type='int', default=3,
+        help='runs per engine, best is reported (%default)')
+    oparser.add_option('-e', '--engines', default=','.join(sorted(hasher.ENGINES)),
+        help='comma separated list of engines (%default)')
+    oparser.add_option('', '--drop-caches', action='store_true', default=False,
+        help='drop page cache before every run (Linux, root only)')
+    (options, args) = oparser.parse_args()
+
+    if args:
+        path = args[0]
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'reposeer_hash_bench.bin')
+        size = options.size * 2 ** 20
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            print('Creating {0} ({1})...'.format(path, bytes_to_human(size)))
+            create_file(path, size)
+    size = os.path.getsize(path)
+
+    results = {}
+    for name in options.engines.split(','):
+        engine = hasher.ENGINES[name]
+        best = None
+        for i in xrange(options.repeat):
+            if options.drop_caches:
+                drop_caches()
+            start = time.time()
+            engine(path)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+        print('{0:10} {1:8.3f} s {2:>12}/s'.format(name, best, bytes_to_human(size / best)))
+
+    if 'read' in results:
+        for name in sorted(results):
+            if name != 'read':
+                print('{0}: {1:.2f}x of read'.format(name, results['read'] / results[name]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of whole runs on synthetic inputs.
+    Generates (or reuses) library and source tree with synthetic module, runs rs.py on them
+    several times with --stats-json and writes collected statistics to one JSON file.
+    Every run gets an empty destination and a fresh source tree if files were moved from it.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shlex
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+import synthetic
+
+RS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'rs.py')
+
+# timings shown in summary: (section, name, key)
+SUMMARY = (
+    ('phases', 'load', 'wall'),
+    ('phases', 'walk', 'wall'),
+    ('phases', 'scan', 'wall'),
+    ('phases', 'cleanup', 'wall'),
+    ('busy', 'hash', 'seconds'),
+    ('busy', 'transfer', 'seconds'),
+    ('busy', 'remove', 'seconds'),
+)
+
+def summarize(runs):
+    'Returns best (minimal) value of every timing over runs.'
+    result = {}
+    for section, name, key in SUMMARY:
+        values = [run[section][name][key] for run in runs if name in run[section]]
+        if values:
+            result['{0}.{1}'.format(name, key)] = min(values)
+    result['wall'] = min(run['wall'] for run in runs)
+    result['peak_rss'] = max(run['peak_rss'] for run in runs)
+    return result
+
+def main():
+    oparser = optparse.OptionParser(usage='%prog [options]', description=__doc__.strip())
+    synthetic.add_options(oparser)
+    oparser.add_option('-w', '--workdir', default=os.path.join(tempfile.gettempdir(), 'reposeer_bench'),
+        help='directory for generated inputs (%default)')
+    oparser.add_option('-r', '--repeat', type='int', default=3,
+        help='number of runs (%default)')
+    oparser.add_option('-m', '--method', default='copy',
+        help='file processing method passed to rs.py (%default)')
+    oparser.add_option('', '--rs-args', default='',
+        help='other arguments for rs.py, e.g. "-j 4 --remove-empty"')
+    oparser.add_option('', '--rebuild-index', action='store_true', default=False,
+        help='load library from scratch in every run instead of mapping its index')
+    oparser.add_option('', '--hash-cache', action='store_true', default=False,
+        help='keep hash cache between runs (hash cache is disabled by default)')
+    oparser.add_option('', '--drop-caches', action='store_true', default=False,
+        help='drop page cache before every run (Linux, root only)')
+    oparser.add_option('-o', '--output', default='-',
+        help='file for JSON results, - for standard output (%default)')
+    (options, args) = oparser.parse_args()
+    if options.repeat < 1:
+        oparser.error('Number of runs must be positive')
+
+    inputs = synthetic.generate_from_options(options.workdir, options)
+    rs_args = shlex.split(options.rs_args)
+    if options.library_format != 'csv' and '--db-user' not in rs_args:
+        oparser.error('rs.py reads libraries from CSV files or MySQL only: '
+            'import library.sqlite into MySQL and pass --db-* options with --rs-args')
+
+    destination = os.path.join(options.workdir, 'destination')
+    stats_path = os.path.join(options.workdir, 'stats.json')
+    command = [sys.executable, RS_PATH, '--no-progressbar', '-m', options.method,
+        '--stats-json', stats_path, '--journal', os.path.join(options.workdir, 'journal.log')]
+    if options.library_format == 'csv':
+        command += ['--csv', inputs['library']]
+    if options.rebuild_index:
+        command.append('--rebuild-index')
+    if options.hash_cache:
+        command += ['--hash-cache', os.path.join(options.workdir, 'hashes.sqlite')]
+    else:
+        command.append('--no-hash-cache')
+    command += rs_args + [inputs['source'], destination]
+    # source is changed by these options
+    changes_source = (options.method == 'move' or
+        any(arg in rs_args for arg in ('-r', '--remove-empty', '--remove-duplicates')))
+
+    runs = []
+    for i in xrange(options.repeat):
+        if changes_source and i > 0:
+            synthetic.regenerate_tree(inputs)
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        os.makedirs(destination)
+        if options.drop_caches:
+            synthetic.drop_caches()
+        print('Run {0} of {1}...'.format(i + 1, options.repeat), file=sys.stderr)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, stdout=devnull)
+        with open(stats_path) as fobj:
+            runs.append(json.load(fobj))
+
+    result = {
+        'inputs': inputs,
+        'command': command,
+        'best': summarize(runs),
+        'runs': runs,
+    }
+    for name, value in sorted(result['best'].items()):
+        print('{0:20} {1:12.3f}'.format(name, value), file=sys.stderr)
+    if options.output == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, 'w') as fobj:
+            json.dump(result, fobj, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+    Generator of reproducible synthetic inputs: a source tree of files and a library
+    (CSV file or SQLite database with the same "updated" table as Library Genesis)
+    which knows some of these files. Same parameters and seed give same inputs.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import json
+import math
+import random
+import shutil
+import struct
+import hashlib
+import sqlite3
+import optparse
+
+FILLER_SIZE = 2 ** 20
+FILES_PER_DIR = 100
+DIRS_PER_DIR = 100
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def drop_caches():
+    'Flushes dirty pages and drops page cache, so benchmarks start cold (Linux, root only).'
+    os.system('sync')
+    with open('/proc/sys/vm/drop_caches', 'w') as fobj:
+        fobj.write('3\n')
+
+def file_sizes(rnd, count, distribution, min_size, max_size):
+    'Returns list of count file sizes between min_size and max_size.'
+    if distribution == 'fixed':
+        return [max_size] * count
+    if distribution == 'uniform':
+        return [rnd.randint(min_size, max_size) for i in xrange(count)]
+    # most files are small, few are big, like books
+    mu = (math.log(max(min_size, 1)) + math.log(max_size)) / 2
+    sigma = (math.log(max_size) - mu) / 3
+    return [int(min(max(rnd.lognormvariate(mu, sigma), min_size), max_size)) for i in xrange(count)]
+
+def file_content(rnd, index, size, filler):
+    '''
+        Returns blocks of file content. Files differ in their first bytes,
+        the rest is taken from shared random filler, so generation is cheap.
+    '''
+    header = struct.pack('<Q', index) + hashlib.md5(str(rnd.random())).digest()
+    data = header[:size]
+    if data:
+        yield data
+    left = size - len(data)
+    while left > 0:
+        block = filler[:left]
+        yield block
+        left -= len(block)
+
+def tree_path(index):
+    dirnum = index // FILES_PER_DIR
+    return os.path.join('d{0:03}'.format(dirnum // DIRS_PER_DIR), 'd{0:05}'.format(dirnum),
+        'f{0:07}.bin'.format(index))
+
+def library_name(index, md5):
+    return '{0}/{1}'.format(index // 1000 * 1000, md5)
+
+def generate_tree(top, files, distribution='lognormal', min_size=2 ** 10, max_size=2 ** 24,
+    match_ratio=0.3, collision_ratio=0.3, seed=0
+):
+    '''
+        Creates files in top and returns list of library entries (filename, size, md5) for them:
+            match_ratio     -- part of files which are in library
+            collision_ratio -- part of files which aren't in library, but have size of some book,
+                               so they have to be hashed
+    '''
+    rnd = random.Random(seed)
+    filler = bytes(bytearray(rnd.getrandbits(8) for i in xrange(FILLER_SIZE)))
+    sizes = file_sizes(rnd, files, distribution, min_size, max_size)
+    entries = []
+    for index, size in enumerate(sizes):
+        path = os.path.join(top, tree_path(index))
+        dirpath = os.path.dirname(path)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        hobj = hashlib.md5()
+        with open(path, 'wb') as fobj:
+            for block in file_content(rnd, index, size, filler):
+                fobj.write(block)
+                hobj.update(block)
+        md5 = hobj.hexdigest()
+        kind = rnd.random()
+        if kind < match_ratio:
+            entries.append((library_name(index, md5), size, md5))
+        elif kind < match_ratio + collision_ratio:
+            # book of the same size with another content
+            entries.append((library_name(index, md5), size, hashlib.md5(md5).hexdigest()))
+    return entries
+
+def library_rows(entries, rows, distribution='lognormal', min_size=2 ** 10, max_size=2 ** 24, seed=0):
+    'Yields entries shuffled with random books, rows in total.'
+    rnd = random.Random(seed + 1)
+    entries = list(entries)
+    rnd.shuffle(entries)
+    fillers = max(rows - len(entries), 0)
+    # random books are inserted evenly between entries
+    step = float(fillers + len(entries)) / max(len(entries), 1)
+    position = 0
+    for index in xrange(fillers + len(entries)):
+        if entries and index >= position * step:
+            yield entries[position]
+            position += 1
+            if position == len(entries):
+                entries = []
+            continue
+        size = file_sizes(rnd, 1, distribution, min_size, max_size)[0]
+        md5 = '{0:032x}'.format(rnd.getrandbits(128))
+        yield library_name(index, md5), size, md5
+
+def write_csv(path, rows, header=True):
+    with open(path, 'wb') as fobj:
+        writer = csv.writer(fobj)
+        if header:
+            writer.writerow(('filename', 'filesize', 'md5'))
+        writer.writerows(rows)
+
+def write_sqlite(path, rows):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE updated (ID INTEGER PRIMARY KEY, Filename TEXT, Filesize INTEGER, '
+        'MD5 TEXT, TimeLastModified TEXT)')
+    conn.executemany('INSERT INTO updated (Filename, Filesize, MD5, TimeLastModified) '
+        "VALUES (?, ?, ?, '2011-01-01 00:00:00')", rows)
+    conn.commit()
+    conn.close()
+
+def generate(workdir, files, rows, library_format='csv', distribution='lognormal', min_size=2 ** 10,
+    max_size=2 ** 24, match_ratio=0.3, collision_ratio=0.3, seed=0
+):
+    '''
+        Creates workdir/source tree and workdir/library.csv or library.sqlite,
+        returns dict with paths and parameters. Inputs are reused if they were generated
+        with the same parameters.
+    '''
+    params = dict(files=files, rows=rows, library_format=library_format, distribution=distribution,
+        min_size=min_size, max_size=max_size, match_ratio=match_ratio, collision_ratio=collision_ratio,
+        seed=seed)
+    inputs = dict(params,
+        source=os.path.join(workdir, 'source'),
+        library=os.path.join(workdir, 'library.' + library_format))
+    params_path = os.path.join(workdir, 'params.json')
+    try:
+        with open(params_path) as fobj:
+            if json.load(fobj) == params:
+                return inputs
+    except (IOError, ValueError):
+        pass
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    if os.path.exists(params_path):
+        os.remove(params_path)
+    entries = regenerate_tree(inputs)
+    print('Generating library of {0} books...'.format(rows))
+    writer = write_csv if library_format == 'csv' else write_sqlite
+    writer(inputs['library'], library_rows(entries, rows, distribution, min_size, max_size, seed))
+    with open(params_path, 'w') as fobj:
+        json.dump(params, fobj)
+    return inputs
+
+def regenerate_tree(inputs):
+    '''
+        Creates source tree of inputs returned by generate() again, e.g. after files were moved from it.
+        Returns library entries for its files.
+    '''
+    if os.path.isdir(inputs['source']):
+        shutil.rmtree(inputs['source'])
+    print('Generating {0} files...'.format(inputs['files']))
+    return generate_tree(inputs['source'], inputs['files'], inputs['distribution'],
+        inputs['min_size'], inputs['max_size'], inputs['match_ratio'], inputs['collision_ratio'],
+        inputs['seed'])
+
+def add_options(oparser):
+    oparser.add_option('-f', '--files', type='int', default=10000,
+        help='number of files in source tree (%default)')
+    oparser.add_option('-b', '--books', type='int', default=1000000,
+        help='number of books in library (%default)')
+    oparser.add_option('', '--library-format', choices=('csv', 'sqlite'), default='csv',
+        help='csv or sqlite (%default)')
+    oparser.add_option('', '--distribution', choices=DISTRIBUTIONS, default='lognormal',
+        help='file size distribution: {0} (%default)'.format(', '.join(DISTRIBUTIONS)))
+    oparser.add_option('', '--min-size', type='int', default=2 ** 10,
+        help='minimum file size in bytes (%default)')
+    oparser.add_option('', '--max-size', type='int', default=2 ** 24,
+        help='maximum file size in bytes (%default)')
+    oparser.add_option('', '--match-ratio', type='float', default=0.3,
+        help='part of files which are in library (%default)')
+    oparser.add_option('', '--collision-ratio', type='float', default=0.3,
+        help='part of files which have size of some book, but are not in library (%default)')
+    oparser.add_option('', '--seed', type='int', default=0,
+        help='random seed (%default)')
+
+def generate_from_options(workdir, options):
+    return generate(workdir, options.files, options.books, options.library_format, options.distribution,
+        options.min_size, options.max_size, options.match_ratio, options.collision_ratio, options.seed)
+
+def main():
+    oparser = optparse.OptionParser(usage='%prog [options] <workdir>', description=__doc__.strip())
+    add_options(oparser)
+    (options, args) = oparser.parse_args()
+    if len(args) != 1:
+        oparser.error('Working directory is not specified')
+    print(json.dumps(generate_from_options(args[0], options), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
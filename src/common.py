@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import inspect
 import functools
 
 
 class ReposeerException(Exception): pass
 
+# Linux system calls (inotify, copy_file_range, FICLONE etc.) may be used
+LINUX = sys.platform.startswith('linux')
+
+# C library loaded by libc_function()
+_libc = None
+
 def copy_args(func):
     '''
         Decorator.
@@ -42,11 +49,42 @@ def copy_args(func):
         func(self, *args, **kwargs)
     return __init__
 
-def dirsize(path):
-    size = 0
-    for path, dirs, files in os.walk(path):
-        size += sum(os.path.getsize(os.path.join(path, file)) for file in files)
-    return size
+def libc_function(name, argtypes, restype=None):
+    '''
+        Returns function of C library which raises OSError with errno when it returns negative value,
+        or None if C library can't be loaded or has no such function.
+    '''
+    global _libc
+    try:
+        import ctypes
+        import ctypes.util
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(_libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    if restype is not None:
+        func.restype = restype
+
+    def call(*args):
+        result = func(*args)
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+    return call
+
+def cache_dir():
+    'Returns path to per-user reposeer cache directory, creating it if needed.'
+    if 'win32' in sys.platform:
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'reposeer')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
 
 def bytes_to_human(bytes):
     bounds = {
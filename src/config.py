@@ -6,13 +6,16 @@ import locale
 import traceback
 
 import console
-from common import ReposeerException
+import fastcopy
+from common import ReposeerException, LINUX
 
 # file processing methods
 M_COPY = 'copy'
 M_MOVE = 'move'
 M_SYMLINK = 'symlink'
 M_HARDLINK = 'hardlink'
+M_REFLINK = 'reflink'
+M_AUTO = 'auto'
 
 # file systems
 FS_NTFS = 'NTFS'
@@ -22,11 +25,15 @@ class Config(object):
         self.terminal_width = console.getTerminalWidth()
         self.encoding = locale.getpreferredencoding()
 
+        # counts files copied by each kernel-side copying method
+        self.copier = fastcopy.FastCopier()
         self.methods = {
             M_COPY: shutil.copyfile,
             M_MOVE: shutil.move,
             M_HARDLINK: None,
             M_SYMLINK: None,
+            M_REFLINK: fastcopy.reflink if LINUX else None,
+            M_AUTO: self.copier.copy,
         }
         self.link_method_names = {
             M_HARDLINK: 'hard',
@@ -37,6 +44,8 @@ class Config(object):
             M_MOVE: 'moved',
             M_HARDLINK: 'created hard links',
             M_SYMLINK: 'created symbolic links',
+            M_REFLINK: 'cloned',
+            M_AUTO: 'copied',
         }
         self.symlink_allowed = True
 
@@ -89,14 +98,16 @@ class Config(object):
         unsupported = 'Your operating system does not support {0} links'
         if method == M_SYMLINK and not self.symlink_allowed:
             return 'Not enough rights to create symbolic links'
+        elif method == M_REFLINK:
+            return 'Your operating system does not support reflinks'
         else:
             return unsupported.format(self.link_method_names[method])
 
-    def checkfs(self, method):
+    def checkfs(self, method, src):
         from win32api import GetVolumeInformation
         from win32file import GetVolumePathName
 
-        src_volume = GetVolumePathName(self.src)
+        src_volume = GetVolumePathName(src)
         dst_volume = GetVolumePathName(self.dst)
         if method == M_HARDLINK and src_volume != dst_volume:
             return 'Hard links can be created only within a single logical drive'
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Physical layout of files: which disk a device number belongs to, whether the disk is rotational
+    and where file data starts on it. Reading files in this order cuts seeks on hard disks.
+    Disks and file extents are known on Linux only, elsewhere files are ordered by inode number
+    and every device is treated as solid state.
+'''
+
+import os
+import array
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SYS_DEV_BLOCK = '/sys/dev/block'
+
+# minimal number of files sorted at once, batches end at directory boundaries
+DEFAULT_BATCH_SIZE = 2 ** 12
+
+FS_IOC_FIEMAP = 0xC020660B
+# start, length, flags, number of mapped extents, number of extents in buffer, reserved
+FIEMAP_FORMAT = struct.Struct('=QQIIII')
+# logical offset, physical offset, length, 2 reserved, flags, 3 reserved
+EXTENT_FORMAT = struct.Struct('=QQQQQIIII')
+FIEMAP_MAX_LENGTH = 2 ** 64 - 1
+FIEMAP_EXTENT_UNKNOWN = 0x00000002
+FIEMAP_EXTENT_DATA_INLINE = 0x00000200
+
+# device number -> disk
+_disks = {}
+
+
+def _sysfs_disk(dev):
+    'Returns sysfs directory of the whole disk holding device number dev or None.'
+    try:
+        path = os.path.realpath(os.path.join(SYS_DEV_BLOCK, '{0}:{1}'.format(os.major(dev), os.minor(dev))))
+    except (AttributeError, OSError):
+        return None
+    if not os.path.isdir(path):
+        # no block device behind file system, e.g. tmpfs or NFS
+        return None
+    if os.path.exists(os.path.join(path, 'partition')):
+        path = os.path.dirname(path)
+    return path
+
+def disk(dev):
+    '''
+        Returns hashable key of the physical disk holding device number dev,
+        so partitions of one disk get the same key. Devices without disk are keys of themselves.
+    '''
+    key = _disks.get(dev)
+    if key is None:
+        key = _disks[dev] = _sysfs_disk(dev) or dev
+    return key
+
+def is_rotational(disk):
+    'True if disk returned by disk() is known to be a hard disk.'
+    if not isinstance(disk, basestring):
+        return False
+    try:
+        with open(os.path.join(disk, 'queue', 'rotational')) as fobj:
+            return fobj.read().strip() == '1'
+    except IOError:
+        return False
+
+def physical_offset(path):
+    'Returns offset of the first byte of file data on disk or None if it is unknown.'
+    if fcntl is None:
+        return None
+    # ioctl() of python 2 fills only array.array in place
+    request = array.array('B', FIEMAP_FORMAT.pack(0, FIEMAP_MAX_LENGTH, 0, 0, 1, 0) + '\0' * EXTENT_FORMAT.size)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    except IOError:
+        # file system doesn't support FIEMAP
+        return None
+    finally:
+        os.close(fd)
+    result = request.tostring()
+    if not FIEMAP_FORMAT.unpack_from(result)[3]:
+        # empty or sparse file
+        return None
+    extent = EXTENT_FORMAT.unpack_from(result, FIEMAP_FORMAT.size)
+    if extent[5] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE):
+        return None
+    return extent[1]
+
+def _sorted(records):
+    def key(record):
+        offset = physical_offset(record.path)
+        return (0, offset) if offset is not None else (1, record.inode)
+    return sorted(records, key=key)
+
+def ordered(records, wanted, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+        Yields records (walker.FileRecord) in batches of whole directories, at least batch_size records each.
+        Within a batch records for which wanted(record) is true are sorted by physical offset
+        of their data (or by inode number if it is unknown) and follow the rest,
+        which are yielded in original order.
+    '''
+    others, batch = [], []
+    dirpath = None
+    for record in records:
+        path = os.path.dirname(record.path)
+        if path != dirpath:
+            if len(others) + len(batch) >= batch_size:
+                for item in others:
+                    yield item
+                for item in _sorted(batch):
+                    yield item
+                others, batch = [], []
+            dirpath = path
+        (batch if wanted(record) else others).append(record)
+    for item in others:
+        yield item
+    for item in _sorted(batch):
+        yield item
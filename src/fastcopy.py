@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Kernel-side file copying for Linux.
+        reflink         -- clones file extents (FICLONE ioctl), works on btrfs, XFS and other CoW file systems
+        copy_file_range -- copies data inside the kernel, may be offloaded to the file system or NAS
+        sendfile        -- copies data inside the kernel without user space buffers
+    FastCopier tries them in that order and falls back to shutil.copyfile.
+'''
+
+import os
+import errno
+import shutil
+import threading
+
+from common import LINUX, libc_function
+
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK_SIZE = 2 ** 30
+
+M_REFLINK = 'reflink'
+M_COPY_FILE_RANGE = 'copy_file_range'
+M_SENDFILE = 'sendfile'
+M_USERSPACE = 'userspace'
+METHODS = (M_REFLINK, M_COPY_FILE_RANGE, M_SENDFILE, M_USERSPACE)
+
+# errors meaning that method is not supported for these files and next one should be tried
+UNSUPPORTED_ERRORS = frozenset(getattr(errno, name) for name in
+    ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EBADF', 'ETXTBSY')
+    if hasattr(errno, name))
+
+
+def _copy_file_range_function():
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range
+    if not LINUX:
+        return None
+    import ctypes
+    func = libc_function('copy_file_range', (ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint), ctypes.c_ssize_t)
+    if func is None:
+        return None
+    # NULL offsets: use and update file positions
+    return lambda src, dst, count: func(src, None, dst, None, count, 0)
+
+def _sendfile_function():
+    if hasattr(os, 'sendfile'):
+        return lambda src, dst, count: os.sendfile(dst, src, None, count)
+    if not LINUX:
+        return None
+    import ctypes
+    func = libc_function('sendfile', (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t),
+        ctypes.c_ssize_t)
+    if func is None:
+        return None
+    return lambda src, dst, count: func(dst, src, None, count)
+
+_copy_file_range = _copy_file_range_function()
+_sendfile = _sendfile_function()
+
+
+def reflink(src, dst):
+    'Creates dst sharing data extents with src. Raises IOError if file system does not support it.'
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except IOError:
+                fdst.close()
+                os.remove(dst)
+                raise
+
+def _kernel_copy(func, fsrc, fdst, size):
+    copied = 0
+    while copied < size:
+        count = func(fsrc.fileno(), fdst.fileno(), min(CHUNK_SIZE, size - copied))
+        if count == 0:
+            # file was truncated while copying
+            break
+        copied += count
+
+
+class FastCopier(object):
+    '''
+        Copies files by the fastest method supported for them and counts how many files
+        were copied by each method. Can be shared between threads.
+    '''
+    def __init__(self):
+        self.counts = dict.fromkeys(METHODS, 0)
+        self._lock = threading.Lock()
+
+    def copy(self, src, dst):
+        method = self._copy(src, dst)
+        with self._lock:
+            self.counts[method] += 1
+
+    def _copy(self, src, dst):
+        if LINUX:
+            try:
+                reflink(src, dst)
+                return M_REFLINK
+            except (IOError, OSError), ex:
+                if ex.errno not in UNSUPPORTED_ERRORS:
+                    raise
+
+            with open(src, 'rb') as fsrc:
+                size = os.fstat(fsrc.fileno()).st_size
+                with open(dst, 'wb') as fdst:
+                    for method, func in ((M_COPY_FILE_RANGE, _copy_file_range), (M_SENDFILE, _sendfile)):
+                        if func is None:
+                            continue
+                        try:
+                            _kernel_copy(func, fsrc, fdst, size)
+                            return method
+                        except (IOError, OSError), ex:
+                            if ex.errno not in UNSUPPORTED_ERRORS:
+                                raise
+                            # start over with the next method
+                            fsrc.seek(0)
+                            fdst.seek(0)
+                            fdst.truncate()
+
+        shutil.copyfile(src, dst)
+        return M_USERSPACE
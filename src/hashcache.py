@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+import threading
+
+from common import ReposeerException
+
+DEFAULT_MAX_ENTRIES = 2000000
+COMMIT_INTERVAL = 1000
+
+def file_key(record):
+    '''
+        Returns (device, inode, size, mtime in nanoseconds) tuple identifying contents
+        of walker.FileRecord or None if file system doesn't provide inode numbers (e.g. Windows).
+    '''
+    if not record.inode:
+        return None
+    return record.dev, record.inode, record.size, record.mtime
+
+
+class HashCache(object):
+    '''
+        Persistent SQLite cache of file md5 hashes.
+        Files are identified by file_key(), so moved or renamed files stay cached
+        and modified files are rehashed. When cache grows over max_entries,
+        least recently used entries are evicted on close().
+        Can be shared between threads.
+    '''
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        self._used = []
+        self._pending = 0
+        self._now = int(time.time())
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, md5 TEXT, used INTEGER,
+                PRIMARY KEY (dev, ino, size, mtime))''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+            self._conn.commit()
+        except sqlite3.Error, ex:
+            raise ReposeerException(u'Unable to open hash cache {0}: {1!s}'.format(path, ex))
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT md5 FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # access time is updated in batch on close
+            self._used.append(key)
+            return str(row[0])
+
+    def put(self, key, md5):
+        if key is None:
+            return
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                key + (md5, self._now))
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE hashes SET used = {0:d} WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?'.format(self._now),
+                self._used)
+            self._used = []
+            count = self._conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY used LIMIT ?)',
+                    (count - self.max_entries,))
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''
+    File hashing engines. Every engine takes file path and returns lowercase hex md5.
+        read     -- reads file by fixed blocks into new string objects
+        readinto -- reads file into reusable per-thread buffer, block size depends on file size
+        mmap     -- hashes memory-mapped file without copying it
+    Buffered engines hint the kernel that file is read once sequentially,
+    so bulk hashing doesn't evict useful data from page cache.
+'''
+
+import io
+import os
+import mmap
+import hashlib
+import threading
+
+from common import LINUX, libc_function
+
+READ_BLOCK_SIZE = 2 ** 20 # one mbyte
+MIN_BLOCK_SIZE = 2 ** 18
+MAX_BLOCK_SIZE = 2 ** 20
+# desired minimum number of blocks per file
+BLOCKS_PER_FILE = 64
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+POSIX_FADV_NOREUSE = 5
+
+
+def _load_fadvise():
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    if not LINUX:
+        return None
+    import ctypes
+    argtypes = (ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int)
+    return libc_function('posix_fadvise64', argtypes) or libc_function('posix_fadvise', argtypes)
+
+_fadvise = _load_fadvise()
+
+def fadvise(fd, offset, length, advice):
+    'posix_fadvise() if platform supports it, hints are ignored otherwise.'
+    if _fadvise is None:
+        return
+    try:
+        _fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def block_size(size, blksize=0):
+    'Picks read block size: at least BLOCKS_PER_FILE blocks per file, multiple of device block size.'
+    block = MIN_BLOCK_SIZE
+    while block < MAX_BLOCK_SIZE and block * BLOCKS_PER_FILE < size:
+        block *= 2
+    if blksize > 0 and block % blksize:
+        block += blksize - block % blksize
+    return block
+
+
+def md5_read(path):
+    with open(path, 'rb') as fobj:
+        hobj = hashlib.md5()
+        block = fobj.read(READ_BLOCK_SIZE)
+        while block:
+            hobj.update(block)
+            block = fobj.read(READ_BLOCK_SIZE)
+    return hobj.hexdigest().lower()
+
+
+_buffers = threading.local()
+
+def _get_buffer(size):
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+def md5_readinto(path):
+    with io.open(path, 'rb', buffering=0) as fobj:
+        fd = fobj.fileno()
+        st = os.fstat(fd)
+        fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        fadvise(fd, 0, 0, POSIX_FADV_NOREUSE)
+        size = block_size(st.st_size, getattr(st, 'st_blksize', 0))
+        view = memoryview(_get_buffer(size))[:size]
+        hobj = hashlib.md5()
+        count = fobj.readinto(view)
+        while count:
+            hobj.update(view[:count])
+            count = fobj.readinto(view)
+        # NOREUSE is a no-op in older Linux kernels, drop pages explicitly
+        fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    return hobj.hexdigest().lower()
+
+def md5_mmap(path):
+    with open(path, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if size == 0:
+            # empty files can't be mapped
+            return hashlib.md5().hexdigest()
+        hobj = hashlib.md5()
+        buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            step = block_size(size)
+            for offset in xrange(0, size, step):
+                hobj.update(buffer(buf, offset, step))
+        finally:
+            buf.close()
+    return hobj.hexdigest().lower()
+
+
+ENGINES = {
+    'read': md5_read,
+    'readinto': md5_readinto,
+    'mmap': md5_mmap,
+}
+DEFAULT_ENGINE = 'read'
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+
+from common import ReposeerException
+
+# journal is fsync'ed after this many records or seconds, whichever comes first
+SYNC_RECORDS = 1000
+SYNC_SECONDS = 5.0
+
+A_ADDED = 'added'
+A_DUPLICATE = 'duplicate'
+A_SKIPPED = 'skipped'
+
+
+class Journal(object):
+    '''
+        Write-ahead journal of completed file operations.
+        Every line is a JSON list [action, md5, source path].
+        When resuming, files recorded in the journal are not processed again.
+        Lines are fsync'ed in batches, so crash loses only the last batch
+        and these files are simply processed once more.
+    '''
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        try:
+            if resume and os.path.isfile(path):
+                self._read()
+            self._fobj = open(path, 'ab' if resume else 'wb')
+        except IOError, ex:
+            raise ReposeerException(u'Unable to open journal {0}: {1!s}'.format(path, ex))
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def _read(self):
+        with open(self.path, 'rb') as fobj:
+            for line in fobj:
+                try:
+                    action, md5, path = json.loads(line)
+                except ValueError:
+                    # last line could be written partially
+                    continue
+                self.done.add(path)
+
+    def record(self, path, md5, action):
+        if isinstance(path, str):
+            # undecodable file name, it just won't match on resume
+            path = path.decode('utf-8', 'replace')
+        self._fobj.write(json.dumps([action, md5, path]) + '\n')
+        self._unsynced += 1
+        if self._unsynced >= SYNC_RECORDS or time.time() - self._synced_at >= SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        self._fobj.flush()
+        os.fsync(self._fobj.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def close(self, remove=False):
+        'Syncs and closes journal. Journal of completed run can be removed.'
+        self.sync()
+        self._fobj.close()
+        if remove:
+            os.remove(self.path)
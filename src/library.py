@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import array
+import struct
+import binascii
+
+DIGEST_SIZE = 16
+
+# Library buffer sections in order of placement
+SECTIONS = ('digests', 'sizes', 'bysize', 'distinct', 'offsets', 'names')
+
+# binary index file: header, source key (utf-8), sections of Library buffer
+INDEX_MAGIC = 'RSLIBIDX'
+INDEX_VERSION = 3
+# magic, version, key length, count and positions of sections
+HEADER_FORMAT = struct.Struct('<8sIIQ' + 'Q' * len(SECTIONS))
+
+SIZE_FORMAT = struct.Struct('<q')
+OFFSET_FORMAT = struct.Struct('<Q')
+INDEX_FORMAT = struct.Struct('<I')
+ORDER_FORMAT = struct.Struct('>I')
+SIZE_ORDER_FORMAT = struct.Struct('>QI')
+# number of name offsets shifted at once when libraries are merged
+REBASE_CHUNK = 2 ** 16
+# entries are sorted by buckets, so only a small part of sort keys exists at once:
+# by the first byte of digest and by bit length of size with 3 following bits
+DIGEST_BUCKETS = 256
+SIZE_BUCKETS = 65 << 3
+
+
+def size_bucket(size):
+    'Returns order-preserving bucket number of non-negative size.'
+    length = size.bit_length()
+    if length < 4:
+        return size
+    return (length << 3) | ((size >> (length - 4)) & 7)
+
+def _buckets(count, bucket_of, buckets):
+    'Splits entry numbers 0..count-1 into arrays by bucket_of(entry number), keeping their order.'
+    result = [array.array('I') for i in xrange(buckets)]
+    for i in xrange(count):
+        result[bucket_of(i)].append(i)
+    return result
+
+def digest_from_hex(md5):
+    'Converts hex md5 string to 16-byte binary digest or returns None if string is not md5.'
+    if len(md5) != DIGEST_SIZE * 2:
+        return None
+    try:
+        return binascii.unhexlify(md5)
+    except (TypeError, ValueError):
+        return None
+
+
+class Library(object):
+    '''
+        Compact read-only index of Library Genesis books.
+        Behaves like a dict {hex md5: (filename, size)}, but keeps everything
+        in a single buffer:
+            digests -- sorted 16-byte binary md5 digests
+            sizes   -- parallel array of int64 file sizes
+            bysize  -- uint32 entry numbers sorted by file size (size -> entries multimap)
+            distinct -- sorted int64 distinct file sizes
+            offsets -- count + 1 uint64 offsets of file names in names blob
+            names   -- utf-8 encoded file names, one after another
+        Any object that supports slicing and struct.unpack_from (str, bytearray, mmap) can be a buffer.
+    '''
+    def __init__(self, buf, count, positions):
+        self._buf = buf
+        self._count = count
+        self._positions = positions
+        self._digests_at = positions['digests']
+        self._sizes_at = positions['sizes']
+        self._bysize_at = positions['bysize']
+        self._distinct_at = positions['distinct']
+        self._distinct_count = (positions['offsets'] - positions['distinct']) // SIZE_FORMAT.size
+        self._offsets_at = positions['offsets']
+        self._names_at = positions['names']
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, md5):
+        return self._find(md5) is not None
+
+    def __getitem__(self, md5):
+        index = self._find(md5)
+        if index is None:
+            raise KeyError(md5)
+        return self._name(index), self._size(index)
+
+    def get(self, md5, default=None):
+        index = self._find(md5)
+        if index is None:
+            return default
+        return self._name(index), self._size(index)
+
+    def has_size(self, size):
+        'Checks if there is a book of given size.'
+        lo, hi = 0, self._distinct_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = SIZE_FORMAT.unpack_from(self._buf, self._distinct_at + mid * SIZE_FORMAT.size)[0]
+            if current < size:
+                lo = mid + 1
+            elif current > size:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def candidates(self, size):
+        'Returns list of (hex md5, filename) of books with given size.'
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._size(self._bysize(mid)) < size:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < self._count:
+            index = self._bysize(lo)
+            if self._size(index) != size:
+                break
+            result.append((binascii.hexlify(self._digest(index)), self._name(index)))
+            lo += 1
+        return result
+
+    def save(self, path, key):
+        '''
+            Writes index to binary file which can be opened later by open_index().
+            Key identifies state of the source the library was loaded from.
+        '''
+        key = key.encode('utf-8')
+        start = self._positions[SECTIONS[0]]
+        end = self._names_at + OFFSET_FORMAT.unpack_from(
+            self._buf, self._offsets_at + self._count * OFFSET_FORMAT.size)[0]
+        shift = HEADER_FORMAT.size + len(key) - start
+        header = HEADER_FORMAT.pack(INDEX_MAGIC, INDEX_VERSION, len(key), self._count,
+            *(self._positions[name] + shift for name in SECTIONS))
+
+        # write to temporary file first, so interrupted save never leaves broken index
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as fobj:
+            fobj.write(header)
+            fobj.write(key)
+            fobj.write(buffer(self._buf, start, end - start))
+        if 'win32' in sys.platform and os.path.exists(path):
+            # os.rename can't replace files on Windows, elsewhere it replaces them atomically
+            os.remove(path)
+        os.rename(tmppath, path)
+
+    def close(self):
+        'Unmaps index file, if library was opened from it.'
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+    def _find(self, md5):
+        digest = digest_from_hex(md5)
+        if digest is None:
+            return None
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._digest(mid)
+            if current < digest:
+                lo = mid + 1
+            elif current > digest:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _digest(self, index):
+        pos = self._digests_at + index * DIGEST_SIZE
+        return self._buf[pos:pos + DIGEST_SIZE]
+
+    def _size(self, index):
+        return SIZE_FORMAT.unpack_from(self._buf, self._sizes_at + index * SIZE_FORMAT.size)[0]
+
+    def _bysize(self, position):
+        return INDEX_FORMAT.unpack_from(self._buf, self._bysize_at + position * INDEX_FORMAT.size)[0]
+
+    def _name(self, index):
+        pos = self._offsets_at + index * OFFSET_FORMAT.size
+        start = OFFSET_FORMAT.unpack_from(self._buf, pos)[0]
+        end = OFFSET_FORMAT.unpack_from(self._buf, pos + OFFSET_FORMAT.size)[0]
+        return self._buf[self._names_at + start:self._names_at + end].decode('utf-8')
+
+
+def read_index(path):
+    '''
+        Maps binary index file written by Library.save() into memory.
+        Returns (library, key) or None if there is no index, it is broken or has another format version.
+    '''
+    try:
+        with open(path, 'rb') as fobj:
+            if os.fstat(fobj.fileno()).st_size < HEADER_FORMAT.size:
+                return None
+            buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, mmap.error):
+        return None
+
+    header = HEADER_FORMAT.unpack_from(buf, 0)
+    magic, version, keylen, count = header[:4]
+    positions = header[4:]
+    if (magic != INDEX_MAGIC or version != INDEX_VERSION
+        or list(positions) != sorted(positions) or positions[-1] > len(buf)
+    ):
+        buf.close()
+        return None
+    try:
+        key = buf[HEADER_FORMAT.size:HEADER_FORMAT.size + keylen].decode('utf-8')
+    except UnicodeDecodeError:
+        buf.close()
+        return None
+    return Library(buf, count, dict(zip(SECTIONS, positions))), key
+
+def open_index(path, key):
+    '''
+        Maps binary index file written by Library.save() into memory.
+        Returns None if there is no index, it is broken, outdated or has another format version.
+    '''
+    result = read_index(path)
+    if result is None:
+        return None
+    library, stored_key = result
+    if stored_key != key:
+        library.close()
+        return None
+    return library
+
+
+class LibraryBuilder(object):
+    '''
+        Accumulates books in packed form while loader streams them
+        and builds Library from them. If md5 occurs more than once, last entry wins.
+    '''
+    def __init__(self):
+        self._digests = bytearray()
+        self._sizes = bytearray()
+        self._offsets = bytearray(OFFSET_FORMAT.pack(0))
+        self._names = bytearray()
+        self.count = 0
+        self.skipped = 0
+
+    def add(self, md5, name, size):
+        digest = digest_from_hex(md5)
+        if digest is None:
+            self.skipped += 1
+            return
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self._digests += digest
+        self._sizes += SIZE_FORMAT.pack(size)
+        self._names += name
+        self._offsets += OFFSET_FORMAT.pack(len(self._names))
+        self.count += 1
+
+    def extend(self, library):
+        'Adds all books of another library.'
+        count = library._count
+        offsets_end = library._offsets_at + (count + 1) * OFFSET_FORMAT.size
+        names_end = library._names_at + OFFSET_FORMAT.unpack_from(library._buf, offsets_end - OFFSET_FORMAT.size)[0]
+        self._append(count,
+            library._buf[library._digests_at:library._digests_at + count * DIGEST_SIZE],
+            library._buf[library._sizes_at:library._sizes_at + count * SIZE_FORMAT.size],
+            library._buf[library._offsets_at + OFFSET_FORMAT.size:offsets_end],
+            library._buf[library._names_at:names_end])
+
+    def packed(self):
+        'Returns accumulated books as a tuple of strings, which is cheap to pass to another process.'
+        return (self.count, self.skipped, bytes(self._digests), bytes(self._sizes),
+            bytes(self._offsets[OFFSET_FORMAT.size:]), bytes(self._names))
+
+    def add_packed(self, packed):
+        'Adds books returned by packed() of another builder.'
+        count, skipped, digests, sizes, offsets, names = packed
+        self._append(count, digests, sizes, offsets, names)
+        self.skipped += skipped
+
+    def _append(self, count, digests, sizes, offsets, names):
+        # offsets are end offsets of names, relative to the start of names
+        self._digests += digests
+        self._sizes += sizes
+        base = len(self._names)
+        if base:
+            step = REBASE_CHUNK * OFFSET_FORMAT.size
+            for pos in xrange(0, len(offsets), step):
+                chunk = offsets[pos:pos + step]
+                fmt = '<{0}Q'.format(len(chunk) // OFFSET_FORMAT.size)
+                self._offsets += struct.pack(fmt, *[offset + base for offset in struct.unpack(fmt, chunk)])
+        else:
+            self._offsets += offsets
+        self._names += names
+        self.count += count
+
+    def build(self):
+        sections = dict((name, bytearray()) for name in SECTIONS)
+        digests, sizes, offsets, names = (sections[name] for name in ('digests', 'sizes', 'offsets', 'names'))
+        offsets += OFFSET_FORMAT.pack(0)
+        source = self._digests
+        for bucket in _buckets(self.count, lambda i: source[i * DIGEST_SIZE], DIGEST_BUCKETS):
+            # digest + big endian index: sorting keeps equal digests in insertion order
+            keys = [bytes(source[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]) + ORDER_FORMAT.pack(i) for i in bucket]
+            keys.sort()
+            for i, key in enumerate(keys):
+                digest = key[:DIGEST_SIZE]
+                if i + 1 < len(keys) and keys[i + 1].startswith(digest):
+                    # duplicate md5, next entry is newer
+                    continue
+                index = ORDER_FORMAT.unpack(key[DIGEST_SIZE:])[0]
+                digests += digest
+                sizes += self._sizes[index * SIZE_FORMAT.size:(index + 1) * SIZE_FORMAT.size]
+                start, end = struct.unpack_from('<QQ', self._offsets, index * OFFSET_FORMAT.size)
+                names += self._names[start:end]
+                offsets += OFFSET_FORMAT.pack(len(names))
+        # unsorted books aren't needed anymore, builder is left empty
+        source = None
+        self.__init__()
+
+        count = len(digests) // DIGEST_SIZE
+        size_of = lambda i: SIZE_FORMAT.unpack_from(sections['sizes'], i * SIZE_FORMAT.size)[0]
+        bysize, distinct = sections['bysize'], sections['distinct']
+        last_size = None
+        for bucket in _buckets(count, lambda i: size_bucket(size_of(i)), SIZE_BUCKETS):
+            # size + entry number: sorting groups entries by size
+            keys = [SIZE_ORDER_FORMAT.pack(size_of(i), i) for i in bucket]
+            keys.sort()
+            for key in keys:
+                size, index = SIZE_ORDER_FORMAT.unpack(key)
+                bysize += INDEX_FORMAT.pack(index)
+                if size != last_size:
+                    distinct += SIZE_FORMAT.pack(size)
+                    last_size = size
+        del digests, sizes, offsets, names, bysize, distinct
+
+        # the first section grows into the buffer (realloc doesn't copy large blocks),
+        # others are freed as soon as they are appended
+        buf, positions = sections.pop(SECTIONS[0]), {SECTIONS[0]: 0}
+        for name in SECTIONS[1:]:
+            positions[name] = len(buf)
+            buf += sections.pop(name)
+        return Library(buf, count, positions)
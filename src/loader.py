@@ -1,57 +1,301 @@
 # -*- coding: utf-8 -*-
 
+import os
 import csv
+import itertools
+import multiprocessing
 import MySQLdb
+import MySQLdb.cursors
 
 from pbar import ProgressBar
-from common import ReposeerException, copy_args
+from library import LibraryBuilder, open_index, read_index
+from common import ReposeerException, copy_args, cache_dir
 
-PROGRESSBAR_UPDATE_INTERVAL = 10000
+# how library was loaded: mapped up-to-date index, updated outdated one, loaded from scratch
+L_INDEX = 'index'
+L_UPDATE = 'update'
+L_SOURCE = 'source'
 
-class CSVLoader(object):
+# csv file is parsed by shards of this size, read by blocks
+CSV_SHARD_SIZE = 2 ** 26
+CSV_BLOCK_SIZE = 2 ** 22
+# progress of csv file parsed in one stream is updated every this number of lines
+CSV_PROGRESS_LINES = 2 ** 12
+# seconds, practically infinite
+POOL_WAIT_TIMEOUT = 2 ** 31
+# rows fetched from server-side cursor at once
+DB_FETCH_SIZE = 10000
+
+class IndexedLoader(object):
+    '''
+        Base class for library loaders.
+        Loaded library is saved to binary index file, and next runs map this file
+        into memory instead of loading library from scratch, until source changes.
+        When source has changed, loaders that support it bring outdated index up to date
+        instead of loading everything again.
+        Subclasses implement index_path(), index_key() and _load(), and may implement _update().
+        After loading, loaded_from tells how library was obtained.
+    '''
+    loaded_from = None
+
+    def load(self, pbar_enabled, rebuild_index=False):
+        try:
+            key = self.index_key()
+            try:
+                path = self.index_path()
+            except (IOError, OSError):
+                # index is just a cache, work without it
+                path = None
+
+            library = None
+            if path is not None and not rebuild_index:
+                library = open_index(path, key)
+                if library is not None:
+                    self.loaded_from = L_INDEX
+                    return library
+                previous = read_index(path)
+                if previous is not None:
+                    previous_library, previous_key = previous
+                    try:
+                        library = self._update(previous_library, previous_key, pbar_enabled)
+                    finally:
+                        previous_library.close()
+                    if library is not None:
+                        self.loaded_from = L_UPDATE
+            if library is None:
+                library = self._load(pbar_enabled)
+                self.loaded_from = L_SOURCE
+            if path is not None:
+                try:
+                    library.save(path, key)
+                except (IOError, OSError):
+                    pass
+            return library
+        finally:
+            self.close()
+
+    def _update(self, library, key, pbar_enabled):
+        '''
+            Returns library updated with changes made to the source since it had the key,
+            or None if it can't be updated.
+        '''
+        return None
+
+    def close(self):
+        pass
+
+def _csv_shards(path, size, shard_size):
+    'Splits file into byte ranges of about shard_size bytes, aligned on line boundaries.'
+    bounds = [0]
+    with open(path, 'rb') as fobj:
+        for pos in xrange(shard_size, size, shard_size):
+            if pos <= bounds[-1]:
+                # previous line was longer than shard
+                continue
+            # next line after byte pos - 1 starts at pos if pos is already line start
+            fobj.seek(pos - 1)
+            fobj.readline()
+            bound = fobj.tell()
+            if bound >= size:
+                break
+            bounds.append(bound)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+class MalformedRowError(ReposeerException):
+    'Row of csv file is not (filename, filesize, md5).'
+
+
+def _add_csv_rows(builder, rows, fieldnames, header):
+    'Adds books from csv rows to builder, first row is skipped if header is True and it is a header.'
+    if header:
+        row = next(rows, None)
+        if row is not None and tuple(field.lower() for field in row) != fieldnames:
+            # not a header
+            rows = itertools.chain([row], rows)
+    for row in rows:
+        if not row:
+            # blank line
+            continue
+        try:
+            name, size, md5 = row
+            size = int(size)
+        except ValueError:
+            raise MalformedRowError(u'Malformed row in library csv file: {0!r}'.format(row))
+        builder.add(md5, name, size)
+
+def _parse_csv_file(builder, path, fieldnames, pbar):
+    '''
+        Adds books from whole csv file to builder in one stream.
+        Unlike shards, quoted fields may contain line breaks here.
+    '''
+    with open(path, 'rb') as fobj:
+        def lines():
+            pos = 0
+            for i, line in enumerate(fobj):
+                pos += len(line)
+                if not i % CSV_PROGRESS_LINES:
+                    pbar.set(pos)
+                yield line
+        _add_csv_rows(builder, csv.reader(lines()), fieldnames, header=True)
+
+def _parse_csv_range(builder, path, start, end, fieldnames):
+    '''
+        Adds books from lines of csv file between start and end offsets to builder.
+        Header is looked for only at the start of file.
+        Shards are split on line breaks, so quoted field containing one can be split:
+        then MalformedRowError is raised for its first part.
+    '''
+    with open(path, 'rb') as fobj:
+        def lines():
+            fobj.seek(start)
+            pos = start
+            while pos < end:
+                data = fobj.read(min(CSV_BLOCK_SIZE, end - pos))
+                if not data:
+                    break
+                if pos + len(data) < end and not data.endswith('\n'):
+                    data += fobj.readline()
+                for line in data.splitlines(True):
+                    yield line
+                pos += len(data)
+        # one reader for the whole shard, so blocks may split quoted fields
+        _add_csv_rows(builder, csv.reader(lines()), fieldnames, header=start == 0)
+
+def _parse_csv_shard(args):
+    path, start, end, fieldnames = args
+    builder = LibraryBuilder()
+    _parse_csv_range(builder, path, start, end, fieldnames)
+    return builder.packed()
+
+class CSVLoader(IndexedLoader):
+    '''
+        Loads library from csv file (filename, filesize, md5) with optional header.
+        Big files are split into shards which are parsed by several processes.
+        If quoted field with line break turns out to be split between shards,
+        the file is parsed again in one stream.
+    '''
     @copy_args
-    def __init__(self, filename):
+    def __init__(self, filename, jobs=1):
         self.fieldnames = ('filename', 'filesize', 'md5')
 
-    def load(self, pbar_enabled):
-        fobj = open(self.filename)
-        pbar = ProgressBar(maxval=len(fobj.readlines()), enabled=pbar_enabled)
-        fobj.seek(0)
-        reader = csv.DictReader(fobj, fieldnames=self.fieldnames)
-
-        # skip header
-        header = reader.next()
-        for fieldname in header:
-            if fieldname != header[fieldname].lower():
-                # header not found
-                fobj.seek(0)
-                break
+    def index_path(self):
+        return self.filename + '.idx'
+
+    def index_key(self):
+        stat = os.stat(self.filename)
+        return u'csv:{0}:{1!r}'.format(stat.st_size, stat.st_mtime)
 
-        library = {}
-        for entry in reader:
-            library[entry['md5'].lower()] = (entry['filename'], int(entry['filesize']))
-            if reader.line_num % PROGRESSBAR_UPDATE_INTERVAL == 0:
-                pbar.set(reader.line_num)
+    def _load(self, pbar_enabled):
+        size = os.path.getsize(self.filename)
+        # progress is measured in bytes, so the file is read only once
+        pbar = ProgressBar(maxval=max(size, 1), enabled=pbar_enabled)
+        shards = _csv_shards(self.filename, size, CSV_SHARD_SIZE)
+        builder = LibraryBuilder()
+        if self.jobs <= 1 or len(shards) == 1:
+            _parse_csv_file(builder, self.filename, self.fieldnames, pbar)
+        else:
+            try:
+                self._parse_shards(builder, shards, pbar)
+            except MalformedRowError:
+                # shard boundary is inside a quoted field (or the file is broken, then it fails again)
+                builder = LibraryBuilder()
+                _parse_csv_file(builder, self.filename, self.fieldnames, pbar)
         pbar.finish()
-        fobj.close()
-        return library
+        return builder.build()
+
+    def _parse_shards(self, builder, shards, pbar):
+        pool = multiprocessing.Pool(min(self.jobs, len(shards)))
+        try:
+            # shards are merged in file order, so later entries still win
+            results = pool.imap(_parse_csv_shard,
+                ((self.filename, start, end, self.fieldnames) for start, end in shards))
+            for start, end in shards:
+                # waiting with timeout keeps main process interruptible by Ctrl+C
+                builder.add_packed(results.next(POOL_WAIT_TIMEOUT))
+                pbar.set(end)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
-class DBLoader(object):
+class DBLoader(IndexedLoader):
     @copy_args
-    def __init__(self, host, name, user, passwd):
-        pass
+    def __init__(self, host, name, user, passwd, fetch_size=DB_FETCH_SIZE):
+        self.conn = None
+        # number of rows, known after index_key()
+        self.count = None
 
-    def load(self, pbar_enabled):
-        try:
-            conn = MySQLdb.connect(host=self.host, db=self.name, user=self.user, passwd=self.passwd, use_unicode=True)
-        except MySQLdb.OperationalError, ex:
-            raise ReposeerException(u'MySQL error: %s' % ex.args[1])
-        cursor = conn.cursor()
-        cursor.execute("SELECT Filename, Filesize, MD5 FROM updated WHERE Filename != ''")
-        library = {}
-        for entry in cursor:
-            name, size, md5 = entry
-            library[md5.lower()] = (name, size)
+    def connect(self):
+        if self.conn is None:
+            try:
+                self.conn = MySQLdb.connect(host=self.host, db=self.name, user=self.user, passwd=self.passwd, use_unicode=True)
+            except MySQLdb.OperationalError, ex:
+                raise ReposeerException(u'MySQL error: %s' % ex.args[1])
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def index_path(self):
+        return os.path.join(cache_dir(), u'{0}-{1}.idx'.format(self.host, self.name))
+
+    def index_key(self):
+        # table is only appended and updated, so row count with max id and modification time
+        # identify its state well enough
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT COUNT(*), MAX(ID), MAX(TimeLastModified) FROM updated WHERE Filename != ''")
+        self.count, max_id, last_modified = cursor.fetchone()
+        cursor.close()
+        return u'db:{0}:{1}:{2}'.format(self.count, max_id, last_modified)
+
+    def _load(self, pbar_enabled):
+        if self.count is None:
+            self.index_key()
+        builder = LibraryBuilder()
+        self._fetch(builder, self.count, pbar_enabled)
+        return builder.build()
+
+    def _update(self, library, key, pbar_enabled):
+        # only rows added or modified since the index was saved are fetched,
+        # they replace old entries with the same md5;
+        # entries of deleted rows and old md5s of modified rows are left in the index
+        # until it is rebuilt
+        parts = key.split(u':', 3)
+        if len(parts) != 4 or parts[0] != u'db' or parts[2] == u'None':
+            return None
+        max_id, last_modified = parts[2:]
+        # modification time has one second precision, rows changed in that second are fetched again
+        condition = "ID > %s OR TimeLastModified >= %s"
+        cursor = self.connect().cursor()
+        cursor.execute("SELECT COUNT(*) FROM updated WHERE Filename != '' AND (" + condition + ")",
+            (max_id, last_modified))
+        count = cursor.fetchone()[0]
         cursor.close()
-        conn.close()
-        return library
+
+        builder = LibraryBuilder()
+        builder.extend(library)
+        self._fetch(builder, count, pbar_enabled, condition, (max_id, last_modified))
+        return builder.build()
+
+    def _fetch(self, builder, count, pbar_enabled, condition=None, params=None):
+        pbar = ProgressBar(maxval=max(count, 1), enabled=pbar_enabled)
+        query = "SELECT Filename, Filesize, MD5 FROM updated WHERE Filename != ''"
+        if condition is not None:
+            query += " AND (" + condition + ")"
+        # server-side cursor streams rows instead of pulling the whole table into client memory
+        cursor = self.connect().cursor(MySQLdb.cursors.SSCursor)
+        cursor.execute(query, params)
+        fetched = 0
+        rows = cursor.fetchmany(self.fetch_size)
+        while rows:
+            for name, size, md5 in rows:
+                builder.add(md5, name, size)
+            fetched += len(rows)
+            # rows may be added since counting
+            pbar.set(min(fetched, pbar.maxval))
+            rows = cursor.fetchmany(self.fetch_size)
+        cursor.close()
+        pbar.finish()
@@ -2,16 +2,54 @@
 # author: Roman Kharitonov, refaim.vl@gmail.com
 
 import sys
+import time
+import threading
+import collections
 
 import console
 from common import copy_args, bytes_to_human
 
 
+# seconds between redraws
+REDRAW_INTERVAL = 0.2
+# progress bar is redrawn in background if it wasn't updated for this number of seconds,
+# so stalled speed and ETA are visible
+IDLE_REDRAW_INTERVAL = 1.0
+# speed is measured over this number of last seconds
+SPEED_WINDOW = 5.0
+MIN_BAR_WIDTH = 10
+
+# statistics shown after the bar, in order of dropping when terminal is too narrow
+STATS_ETA = 'eta'
+STATS_SPEED = 'speed'
+STATS_FILES = 'files'
+# max lengths of statistics strings
+STATS_WIDTHS = {
+    STATS_ETA: len(' ETA 99:59:59'),
+    STATS_SPEED: len(' 1023.99 MiB/s'),
+    STATS_FILES: len(' 99999 files/s'),
+}
+
+
 class ProgressBar(object):
+    '''
+        Progress bar is redrawn not more often than once in REDRAW_INTERVAL seconds,
+        so it can be updated after every processed item.
+        Shows estimated time left and, for sizes and files, recent speed.
+        If progress is not updated for a while, bar is redrawn in background thread.
+    '''
     @copy_args
-    def __init__(self, maxval, fout=sys.stderr, width=None, displaysize=False, enabled=True):
+    def __init__(self, maxval, fout=sys.stderr, width=None, displaysize=False, displayfiles=False,
+        enabled=True, interval=REDRAW_INTERVAL
+    ):
         self.curval = 0
+        self.files = 0
         self.terminal_width = console.getTerminalWidth()
+        self.stats = [STATS_ETA]
+        if self.displaysize:
+            self.stats.append(STATS_SPEED)
+        if self.displayfiles:
+            self.stats.append(STATS_FILES)
         if self.width is None:
             # '[===...===] X%\n'
             # length of _getbarstr()
@@ -19,17 +57,37 @@ class ProgressBar(object):
             if self.displaysize:
                 # subtract max length of size string
                 self.width -= len(' [1023.99 GiB / 9999.99 TiB]')
-
-    def update(self, value):
+            self.width -= sum(STATS_WIDTHS[name] for name in self.stats)
+            while self.width < MIN_BAR_WIDTH and len(self.stats) > 1:
+                self.width += STATS_WIDTHS[self.stats.pop()]
+        self._started = time.time()
+        self._drawn = None
+        # (time, value, files) of recent redraws
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._ticker = None
+
+    def update(self, value, files=0):
         assert value <= self.maxval
         assert (self.curval + value) <= self.maxval
-        self.curval += value
-        self._write()
+        self.set(self.curval + value, self.files + files)
 
-    def set(self, value):
+    def set(self, value, files=None):
         assert value <= self.maxval
         self.curval = value
-        self._write()
+        if files is not None:
+            self.files = files
+        if not self.enabled:
+            return
+        now = time.time()
+        if self._drawn is None or now - self._drawn >= self.interval or value == self.maxval:
+            with self._lock:
+                self._write(now)
+        if self._ticker is None:
+            self._ticker = threading.Thread(target=self._tick)
+            self._ticker.daemon = True
+            self._ticker.start()
 
     def start(self):
         self.set(0)
@@ -37,6 +95,20 @@ class ProgressBar(object):
     def finish(self):
         if self.curval != self.maxval:
             self.set(self.maxval)
+        self.stop()
+
+    def stop(self):
+        'Stops background redrawing, e.g. when work is interrupted.'
+        self._finished.set()
+        if self._ticker is not None:
+            self._ticker.join()
+
+    def _tick(self):
+        while not self._finished.wait(self.interval):
+            with self._lock:
+                now = time.time()
+                if now - self._drawn >= IDLE_REDRAW_INTERVAL and not self._finished.is_set():
+                    self._write(now)
 
     def _getbarstr(self):
         result = u'=' * int(self.percentage() * (self.width / 100.0))
@@ -50,9 +122,40 @@ class ProgressBar(object):
             cur = bytes_to_human(self.curval),
             max = bytes_to_human(self.maxval))
 
-    def _write(self):
-        if not self.enabled:
-            return
+    def _getstatsstr(self, now):
+        samples = self._samples
+        samples.append((now, self.curval, self.files))
+        while len(samples) > 2 and now - samples[1][0] >= SPEED_WINDOW:
+            samples.popleft()
+        then, value, files = samples[0]
+        if now > then:
+            speed = (self.curval - value) / (now - then)
+            files_speed = (self.files - files) / (now - then)
+        else:
+            # first redraw, use average since start
+            elapsed = max(now - self._started, 1e-6)
+            speed = self.curval / elapsed
+            files_speed = self.files / elapsed
+
+        result = u''
+        for name in self.stats:
+            if name == STATS_ETA:
+                if self.curval == self.maxval:
+                    eta = u'0:00:00'
+                elif speed > 0:
+                    eta = _format_time((self.maxval - self.curval) / speed)
+                else:
+                    # stalled
+                    eta = u'-:--:--'
+                result += u' ETA {0}'.format(eta)
+            elif name == STATS_SPEED:
+                result += u' {0}/s'.format(bytes_to_human(speed))
+            elif name == STATS_FILES:
+                result += u' {0:.0f} files/s'.format(files_speed)
+        return result
+
+    def _write(self, now):
+        self._drawn = now
         line = u'[{bar}] {prc}%'.format(
             bar = self._getbarstr(),
             prc = self.percentage()
@@ -62,6 +165,7 @@ class ProgressBar(object):
                 main = line,
                 size = self._getsizestr()
                 )
+        line += self._getstatsstr(now)
 
         if self.curval == self.maxval:
             ending = u'\n'
@@ -77,14 +181,24 @@ class ProgressBar(object):
         self.fout.flush()
 
     def percentage(self):
+        if self.maxval == 0:
+            return 100
         return int(self.curval / float(self.maxval) * 100.0)
 
     def clear(self):
         '(Temporarily) clear progress bar off screen, e.g. to write log line.'
         if not self.enabled:
             return
-        self.fout.write(' ' * (self.terminal_width - len('\r')) + '\r')
-        self.fout.flush()
+        with self._lock:
+            self.fout.write(' ' * (self.terminal_width - len('\r')) + '\r')
+            self.fout.flush()
+
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 100 * 3600:
+        return u'99:59:59'
+    return u'{0}:{1:02}:{2:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
 
 
 class ProgressBarSafeLogger(object):
@@ -99,18 +213,23 @@ class ProgressBarSafeLogger(object):
     def unset_pbar(self):
         self.pbar = None
 
+    def _clear(self):
+        # progress bar is unset between scanning and watching
+        if self.pbar is not None:
+            self.pbar.clear()
+
     def debug(self, *args, **kw):
-        self.pbar.clear()
+        self._clear()
         self.log.debug(*args, **kw)
 
     def info(self, *args, **kw):
-        self.pbar.clear()
+        self._clear()
         self.log.info(*args, **kw)
 
     def warning(self, *args, **kw):
-        self.pbar.clear()
-        self.warning.info(*args, **kw)
+        self._clear()
+        self.log.warning(*args, **kw)
 
     def error(self, *args, **kw):
-        self.pbar.clear()
-        self.error.info(*args, **kw)
+        self._clear()
+        self.log.error(*args, **kw)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import collections
+from Queue import Queue, Empty, Full
+
+# how many items can wait in pipeline per worker
+QUEUE_DEPTH_PER_WORKER = 4
+# python 2 can't interrupt lock waiting without timeout by Ctrl+C
+WAIT_INTERVAL = 0.1
+
+# marks end of items produced by one of merged iterables
+_END = object()
+
+
+class Task(object):
+    'Function call scheduled in WorkerPool.'
+    def __init__(self, func, args):
+        self.func, self.args = func, args
+        self.result, self.exc_info = None, None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def get(self):
+        'Waits for task completion and returns its result or reraises its exception.'
+        while not self._done.wait(WAIT_INTERVAL):
+            pass
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class WorkerPool(object):
+    'Fixed set of daemon threads running submitted tasks in FIFO order.'
+    def __init__(self, workers):
+        self._queue = Queue()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            task.run()
+
+    def submit(self, func, *args):
+        task = Task(func, args)
+        self._queue.put(task)
+        return task
+
+    def close(self, cancel=False):
+        'Stops workers after they finish queued tasks (or only running ones if cancel is True).'
+        if cancel:
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except Empty:
+                pass
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(WAIT_INTERVAL)
+
+
+class Result(object):
+    'Result of function call made without pool, has the same get() as Task.'
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+
+def ordered_map(func, iterable, jobs, depth=None, inline=None):
+    '''
+        Like itertools.imap, but calls func in a pool of jobs threads.
+        Results are yielded in order of items, no more than depth items
+        are read ahead from iterable, so memory usage stays bounded.
+        Items for which inline(item) is true are cheap to process: func is called
+        for them in the calling thread, without overhead of passing them to pool.
+    '''
+    if jobs <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    if depth is None:
+        depth = jobs * QUEUE_DEPTH_PER_WORKER
+    pool = WorkerPool(jobs)
+    pending = collections.deque()
+    completed = False
+    try:
+        for item in iterable:
+            if inline is not None and inline(item):
+                if not pending:
+                    yield func(item)
+                    continue
+                pending.append(Result(func(item)))
+            else:
+                pending.append(pool.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        completed = True
+    finally:
+        pool.close(cancel=not completed)
+
+
+def _produce(iterable, queue, stop):
+    'Puts items of iterable to queue followed by end marker, stops early if stop is set.'
+    def put(entry):
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=WAIT_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    try:
+        for item in iterable:
+            if not put((item, None)):
+                break
+        else:
+            put((_END, None))
+            return
+    except BaseException:
+        put((None, sys.exc_info()))
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+def merge(iterables, depth=QUEUE_DEPTH_PER_WORKER):
+    '''
+        Yields items of several iterables as soon as they are produced,
+        every iterable is consumed in its own thread. Order of items of one iterable is kept.
+        Exception raised by any iterable is reraised here.
+    '''
+    iterables = list(iterables)
+    if len(iterables) == 1:
+        iterable = iter(iterables[0])
+        try:
+            for item in iterable:
+                yield item
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return
+
+    queue = Queue(depth * len(iterables))
+    stop = threading.Event()
+    threads = []
+    for iterable in iterables:
+        thread = threading.Thread(target=_produce, args=(iter(iterable), queue, stop))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        running = len(threads)
+        while running:
+            try:
+                item, exc_info = queue.get(timeout=WAIT_INTERVAL)
+            except Empty:
+                continue
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is _END:
+                running -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(WAIT_INTERVAL)
+
+
+class OrderedExecutor(object):
+    '''
+        Runs submitted calls in a pool of threads (or synchronously if there are no workers)
+        and returns their results in order of submission.
+        No more than depth calls are pending, submit() waits for the oldest one otherwise.
+    '''
+    def __init__(self, workers, depth=None):
+        self._pool = WorkerPool(workers) if workers > 0 else None
+        self._depth = depth or workers * QUEUE_DEPTH_PER_WORKER
+        self._pending = collections.deque()
+
+    def submit(self, tag, func, *args):
+        '''
+            Schedules func(*args) call.
+            Returns list of (tag, result) pairs of calls completed by now.
+        '''
+        if self._pool is None:
+            return [(tag, func(*args))]
+        self._pending.append((tag, self._pool.submit(func, *args)))
+        return self._collect(wait=len(self._pending) >= self._depth)
+
+    def join(self):
+        'Waits for all pending calls and returns list of their (tag, result) pairs.'
+        completed = []
+        while self._pending:
+            completed.extend(self._collect(wait=True))
+        return completed
+
+    def close(self, cancel=False):
+        if self._pool is not None:
+            self._pool.close(cancel)
+
+    def _collect(self, wait):
+        completed = []
+        while self._pending and (wait or self._pending[0][1].done()):
+            tag, task = self._pending.popleft()
+            completed.append((tag, task.get()))
+            wait = False
+        return completed
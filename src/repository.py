@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from walker import scandir
+
+
+# states of names in directory listing
+F_FILE = True # regular file
+F_UNKNOWN = None # listed without file type, checked when looked up
+
+
+def _list_files(path):
+    '''
+        Returns dict of normalized names of files in directory with their states
+        or None if there is no such directory.
+    '''
+    try:
+        if scandir is not None:
+            # file type is known from directory listing, only symbolic links are stat'ed
+            return dict((os.path.normcase(entry.name), F_FILE) for entry in scandir(path) if entry.is_file())
+        # stat'ing every entry would cost more than checking one looked up file
+        return dict((os.path.normcase(name), F_UNKNOWN) for name in os.listdir(path))
+    except OSError:
+        return None
+
+
+class RepositoryIndex(object):
+    '''
+        In-memory index of files in the repository.
+        Every directory is listed once, when it is accessed for the first time,
+        so checking for existing files and creating directories don't cost
+        a round trip to the (possibly remote) file system per file.
+        Names are compared as file system does it (case-insensitively on Windows).
+        Files added during the run must be registered with add() before they are written
+        and with done() after that.
+        Can be shared between threads.
+    '''
+    def __init__(self):
+        # directory path -> {normalized file name: state} (empty if directory doesn't exist yet)
+        self._dirs = {}
+        # directories known to exist
+        self._existing = set()
+        # (directory path, normalized name) of files which are being written
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _files(self, path):
+        with self._lock:
+            files = self._dirs.get(path)
+        if files is not None:
+            return files
+        # remote directory is listed without blocking other threads
+        listed = _list_files(path)
+        with self._lock:
+            files = self._dirs.get(path)
+            if files is None:
+                if listed is None:
+                    files = {}
+                else:
+                    files = listed
+                    self._existing.add(path)
+                self._dirs[path] = files
+            return files
+
+    def exists(self, path):
+        dirpath, name = os.path.split(path)
+        name = os.path.normcase(name)
+        files = self._files(dirpath)
+        with self._lock:
+            state = files.get(name, False)
+        if state is F_UNKNOWN:
+            # directories with names of books must not be taken for books
+            isfile = os.path.isfile(path)
+            with self._lock:
+                if files.get(name, False) is F_UNKNOWN:
+                    if isfile:
+                        files[name] = F_FILE
+                    else:
+                        del files[name]
+        with self._lock:
+            return name in files
+
+    def complete(self, path):
+        'True if file exists and it is not being written by this run.'
+        dirpath, name = os.path.split(path)
+        if not self.exists(path):
+            return False
+        with self._lock:
+            return (dirpath, os.path.normcase(name)) not in self._pending
+
+    def add(self, path):
+        'Registers file which is going to be written, it exists from now on, but is not complete.'
+        dirpath, name = os.path.split(path)
+        name = os.path.normcase(name)
+        files = self._files(dirpath)
+        with self._lock:
+            files[name] = F_FILE
+            self._pending.add((dirpath, name))
+
+    def done(self, path):
+        'Registers that file added with add() is completely written.'
+        dirpath, name = os.path.split(path)
+        with self._lock:
+            self._pending.discard((dirpath, os.path.normcase(name)))
+
+    def makedirs(self, path):
+        'Creates directory with all parents, unless it is known to exist.'
+        with self._lock:
+            if path in self._existing:
+                return
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._existing.add(path)
@@ -6,15 +6,30 @@ from __future__ import print_function
 import sys
 import os
 import hashlib
-import shutil
 import optparse
+import multiprocessing
 import traceback
+import signal
+import cProfile
+import pstats
 import logging
+import itertools
+import collections
 
 import loader
 from version import APP_VERSION
-from common import ReposeerException, dirsize, bytes_to_human
+from common import ReposeerException, bytes_to_human, cache_dir
+from walker import walk, stat_file, PackedRecords
+from repository import RepositoryIndex
+from journal import Journal, A_ADDED, A_DUPLICATE, A_SKIPPED
+from hashcache import HashCache, file_key
+from stats import RunStats, hit_rate
 from pbar import ProgressBar, ProgressBarSafeLogger
+from pipeline import ordered_map, merge, OrderedExecutor
+from watcher import Watcher, DEFAULT_SETTLE_TIME, DEFAULT_POLL_INTERVAL
+import hasher
+import fastcopy
+import diskorder
 from config import *
 
 
@@ -28,8 +43,21 @@ APP_SHORT_NAME = 'rs'
 APP_VERSION_STRING = '{0} {1} by {2} ({3})'.format(
     APP_LONG_NAME, APP_VERSION, APP_AUTHOR, APP_AUTHOR_MAIL)
 
-CHECK_PROGRESS_DIVIDER = 300.0
-MD5_READ_BLOCK_SIZE = 2 ** 20 # one mbyte
+# файлы меньшего размера хешируются без предварительной проверки
+PREFILTER_MIN_SIZE = 2 ** 22 # four mbytes
+PREFILTER_BLOCK_SIZE = 2 ** 16
+
+# секунды, через которые режим наблюдения проверяет, не пора ли завершаться
+WATCH_WAIT_INTERVAL = 1.0
+
+# количество самых долгих функций в отчёте профилировщика
+PROFILE_TOP = 30
+
+# результаты проверки файла перед обработкой
+S_UNMATCHED = 'unmatched' # в базе нет файлов такого размера
+S_RESUMED = 'resumed' # файл обработан в прерванном запуске
+S_REJECTED = 'rejected' # файл отбракован предварительной проверкой
+S_HASHED = 'hashed'
 
 
 class ProgressCounter(object):
@@ -44,48 +72,308 @@ def error(message):
     print(u'{0}: {1}'.format(APP_SHORT_NAME, message))
     return 1
 
-def process(src, dst, options):
+def resolve(src, dst, options):
+    '''
+        Возвращает полные пути к файлу и его месту в репозитории и признак того,
+        что файл уже есть в репозитории (или поставлен в очередь на добавление)
+    '''
     global config, log
+    src = os.path.normpath(src)
+    dst = os.path.normpath(os.path.join(config.dst, dst))
+    duplicate = config.repository.exists(dst)
+    if not duplicate and not options.dry_run:
+        config.repository.add(dst)
+    if options.verbose:
+        if not duplicate:
+            log.info(u'Performing %s: %s -> %s', options.method, src, dst)
+        elif options.remove_duplicates:
+            log.info(u'Removing %s', src)
+    return src, dst, duplicate
+
+def process(src, dst, duplicate, options):
+    ''' Добавляет файл в репозиторий или удаляет дубликат, может выполняться в потоках ввода-вывода '''
+    global config
     errmsg = u'Error while processing file {0}'.format(src) + u':\n{0!s}'
     try:
-        src = os.path.normpath(os.path.join(config.src, src))
-        dst = os.path.normpath(os.path.join(config.dst, dst))
-        duplicate = os.path.isfile(dst)
         if not options.dry_run:
-            dstdir = os.path.dirname(dst)
-            if not os.path.isdir(dstdir):
-                os.makedirs(dstdir)
+            config.repository.makedirs(os.path.dirname(dst))
         try:
             if not duplicate:
-                if options.verbose:
-                    log.info(u'Performing %s: %s -> %s', options.method, src, dst)
                 if not options.dry_run:
-                    config.methods[options.method](src, dst)
+                    with config.stats.timer('transfer'):
+                        config.methods[options.method](src, dst)
+                    # теперь края книги можно сравнивать с другими файлами
+                    config.repository.done(dst)
             elif options.remove_duplicates:
-                if options.verbose:
-                    log.info(u'Removing %s', src)
                 if not options.dry_run:
-                    os.remove(src)
+                    with config.stats.timer('remove'):
+                        os.remove(src)
         except OSError, ex:
             raise ReposeerException(errmsg.format(traceback.format_exc()))
-    except IOError, ex:
+    except (IOError, OSError), ex:
         raise ReposeerException(errmsg.format(traceback.format_exc()))
-    return duplicate
 
-def md5hash(path):
-    ''' Считает md5-хеш файла и возвращает его строковое представление в нижнем регистре '''
+def scan_tree(top):
+    '''
+        Обходит дерево каталогов и возвращает список каталогов в порядке обхода
+        [(путь к каталогу, walker.PackedRecords, количество элементов в каталоге), ...]
+        и общий размер файлов. Каждый файл stat'ится только здесь.
+        Записи о файлах хранятся в сжатом виде, чтобы дерево из миллионов файлов помещалось в памяти
+    '''
+    tree, total = [], 0
+    for path, dirs, files, others in walk(top):
+        total += sum(record.size for record in files)
+        tree.append((path, PackedRecords(path, files), len(dirs) + len(files) + others))
+        config.stats.add('dirs_walked')
+        config.stats.add('files_walked', len(files))
+    return tree, total
+
+def scan_sources(sources):
+    '''
+        Обходит деревья каталогов-источников, как scan_tree(), и возвращает список деревьев
+        в порядке источников и общий размер файлов.
+        Источники на разных устройствах обходятся одновременно
+    '''
+    devices = collections.OrderedDict()
+    for src in sources:
+        devices.setdefault(os.stat(src).st_dev, []).append(src)
+    scanned = {}
+    for group in ordered_map(lambda group: [(src, scan_tree(src)) for src in group],
+        devices.values(), len(devices)
+    ):
+        scanned.update(group)
+    trees = [scanned[src][0] for src in sources]
+    return trees, sum(scanned[src][1] for src in sources)
+
+def group_by_device(batches, device=lambda dev: dev):
+    '''
+        Раскладывает пачки файлов (walker.FileRecord) по устройствам, на которых они лежат, сохраняя их порядок.
+        Устройство пачки определяется по её первому файлу, device(номер устройства) возвращает ключ группы.
+        Возвращает словарь {ключ группы: итератор файлов}, файлы перебираются только при сканировании
+    '''
+    groups = collections.OrderedDict()
+    for batch in batches:
+        for record in batch:
+            groups.setdefault(device(record.dev), []).append(batch)
+            break
+    return collections.OrderedDict((key, itertools.chain.from_iterable(group)) for key, group in groups.items())
+
+def remove_empty_dirs(tree, remaining, options):
+    '''
+        Удаляет опустевшие каталоги дерева, построенного scan_tree(), кроме корневого.
+        remaining -- количество оставшихся элементов в каталогах.
+        Дерево обходится в обратном порядке, поэтому вложенные каталоги удаляются
+        раньше родительских, и каждый каталог проверяется один раз.
+    '''
+    for path, records, entries in reversed(tree[1:]):
+        if remaining[path] > 0:
+            continue
+        if options.verbose:
+            log.info(u'Removing directory %s', path)
+        try:
+            os.rmdir(path)
+        except OSError:
+            # в каталоге появились новые файлы
+            continue
+        remaining[os.path.dirname(path)] -= 1
+
+def read_edges(path, size):
+    ''' Возвращает md5-хеш первого и последнего блоков файла '''
     with open(path, 'rb') as fobj:
-        hobj = hashlib.md5()
-        block = fobj.read(MD5_READ_BLOCK_SIZE)
-        while block:
-            hobj.update(block)
-            block = fobj.read(MD5_READ_BLOCK_SIZE)
-    return hobj.hexdigest().lower()
+        head = fobj.read(PREFILTER_BLOCK_SIZE)
+        fobj.seek(max(size - PREFILTER_BLOCK_SIZE, 0))
+        tail = fobj.read(PREFILTER_BLOCK_SIZE)
+    config.stats.add('prefilter_bytes_read', len(head) + len(tail))
+    return hashlib.md5(head + tail).digest()
+
+def may_match(path, size, candidates):
+    '''
+        Предварительная проверка перед полным чтением файла.
+        В базе есть только md5 целых файлов, поэтому первый и последний блоки файла
+        сравниваются с уже лежащими в репозитории книгами того же размера.
+        Возвращает False, только если все кандидаты есть в репозитории и ни один не совпал,
+        то есть полный хеш файла заведомо не найдётся в базе.
+        Края книг запоминаются на весь запуск
+    '''
+    edges = None
+    for md5, name in candidates:
+        candidate_edges = config.edges_cache.get(md5)
+        if candidate_edges is None:
+            dst = os.path.normpath(os.path.join(config.dst, name))
+            # книга, которую этот запуск ещё записывает, может быть недописана
+            if not config.repository.complete(dst):
+                return True
+            try:
+                candidate_edges = read_edges(dst, size)
+            except IOError:
+                # книги нет в репозитории, совпадение можно проверить только по хешу
+                return True
+            # присваивание элементу словаря атомарно, потоки хеширования могут делать его одновременно
+            config.edges_cache[md5] = candidate_edges
+        if edges is None:
+            edges = read_edges(path, size)
+        if edges == candidate_edges:
+            return True
+    return False
+
+def md5hash(path, cache=None, key=None, prefilter=None, size=0):
+    '''
+        Считает md5-хеш файла и возвращает его строковое представление в нижнем регистре.
+        Возвращает None, если файл отбракован функцией prefilter(path).
+        size нужен только для статистики
+    '''
+    if cache is not None:
+        # неизменённые с прошлого запуска файлы не читаем
+        if key is None:
+            key = file_key(stat_file(path))
+        md5 = cache.get(key)
+        if md5 is not None:
+            return md5
+    if prefilter is not None and not prefilter(path):
+        return None
+    with config.stats.timer('hash', size):
+        md5 = config.hash_engine(path)
+    if cache is not None:
+        cache.put(key, md5)
+    return md5
+
+class Scanner(object):
+    '''
+        Хеширует файлы, ищет их в базе и добавляет найденные в репозиторий.
+        Счётчики накапливаются за все вызовы scan()
+    '''
+    def __init__(self, library, hash_cache, journal, options):
+        self.library = library
+        self.hash_cache = hash_cache
+        self.journal = journal
+        self.options = options
+        self.processed, self.added, self.duplicate = ProgressCounter(), ProgressCounter(), ProgressCounter()
+        # файлы, отбракованные предварительной проверкой, и их размер
+        self.prefiltered = ProgressCounter()
+        # файлы, обработанные в прерванном запуске
+        self.resumed = ProgressCounter()
+        # количество оставшихся в каталогах источника элементов
+        self.remaining = collections.defaultdict(int)
+
+    def skipped(self, record):
+        ''' Возвращает причину, по которой файл не нужно хешировать, или None '''
+        # хешируем, только если в базе есть файл такого размера
+        if not self.library.has_size(record.size):
+            return S_UNMATCHED
+        # и файл не обработан в прерванном запуске
+        if self.journal is not None and record.path in self.journal.done:
+            return S_RESUMED
+        return None
+
+    def hash_candidate(self, record):
+        options, library = self.options, self.library
+        status = self.skipped(record)
+        if status is not None:
+            return record, None, status
+        prefilter = None
+        if options.prefilter and record.size >= PREFILTER_MIN_SIZE:
+            candidates = library.candidates(record.size)
+            # чтение краёв всех кандидатов не должно обходиться дороже хеширования самого файла
+            if 2 * PREFILTER_BLOCK_SIZE * len(candidates) < record.size:
+                prefilter = lambda path: may_match(path, record.size, candidates)
+        md5 = md5hash(record.path, self.hash_cache, file_key(record), prefilter, record.size)
+        return record, md5, S_REJECTED if md5 is None else S_HASHED
+
+    def account(self, record, md5, already_in_repo):
+        if already_in_repo:
+            self.duplicate.add(record.size)
+            removed = self.options.remove_duplicates
+        else:
+            self.added.add(record.size)
+            removed = self.options.method == M_MOVE
+        if removed:
+            self.remaining[os.path.dirname(record.path)] -= 1
+        if self.journal is not None:
+            self.journal.record(record.path, md5, A_DUPLICATE if already_in_repo else A_ADDED)
+
+    def schedule(self, batches):
+        '''
+            Раскладывает пачки файлов (например, каталоги дерева) по устройствам и возвращает список пар
+            (файлы, количество хеширующих потоков). С опцией --disk-order файлы одного физического диска
+            хешируются в порядке их расположения на диске, а вращающийся диск читается одним потоком
+        '''
+        if not self.options.disk_order:
+            return [(group, self.options.jobs) for group in group_by_device(batches).values()]
+        wanted = lambda record: self.library.has_size(record.size)
+        return [(diskorder.ordered(group, wanted), 1 if diskorder.is_rotational(disk) else self.options.jobs)
+            for disk, group in group_by_device(batches, diskorder.disk).items()]
+
+    def scan(self, groups, pbar=None):
+        '''
+            Обрабатывает файлы (walker.FileRecord), разложенные schedule().
+            Каждая группа хешируется своими потоками, поэтому разные устройства читаются одновременно
+        '''
+        options, journal = self.options, self.journal
+        # файлы, которые не нужно хешировать, не передаются в потоки хеширования
+        inline = lambda record: self.skipped(record) is not None
+        results = merge(ordered_map(self.hash_candidate, records, jobs, inline=inline)
+            for records, jobs in groups)
+        transfers = OrderedExecutor(options.io_workers)
+        completed = False
+        try:
+            for record, md5, status in results:
+                filesize = record.size
+                if status == S_REJECTED:
+                    self.prefiltered.add(filesize)
+                elif status == S_RESUMED:
+                    self.resumed.add(filesize)
+                book = self.library.get(md5) if md5 is not None else None
+                # если файл совпал по хешу и размеру
+                if book is not None and book[1] == filesize:
+                    # то обрабатываем его
+                    src, dst, already_in_repo = resolve(record.path, book[0], options)
+                    for (done_record, done_md5, done_duplicate), result in transfers.submit(
+                        (record, md5, already_in_repo), process, src, dst, already_in_repo, options
+                    ):
+                        self.account(done_record, done_md5, done_duplicate)
+                elif journal is not None and status in (S_HASHED, S_REJECTED):
+                    journal.record(record.path, md5, A_SKIPPED)
+
+                self.processed.add(filesize)
+                if pbar is not None:
+                    # индикатор сам решает, когда перерисовываться
+                    pbar.set(self.processed.size, self.processed.count)
+            for (done_record, done_md5, done_duplicate), result in transfers.join():
+                self.account(done_record, done_md5, done_duplicate)
+            completed = True
+        finally:
+            # останавливаем потоки хеширования и ввода-вывода, даже если сканирование прервано
+            results.close()
+            transfers.close(cancel=not completed)
+
+def watch(watcher, scanner, options):
+    ''' Обрабатывает новые файлы источника, пока не будет нажато Ctrl+C или получен SIGTERM '''
+    stop = []
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    print(u'Watching for new files ({0}), press Ctrl+C to stop...'.format(watcher.method))
+    while not stop:
+        try:
+            records = watcher.wait(WATCH_WAIT_INTERVAL)
+        except KeyboardInterrupt:
+            break
+        if not records:
+            continue
+        processed, added, duplicate = scanner.processed.count, scanner.added.count, scanner.duplicate.count
+        with config.stats.phase('watch'):
+            # новые файлы приходят из разных каталогов, устройство определяется для каждого
+            scanner.scan(scanner.schedule([record] for record in records))
+        print(u'{0} new files: {1} added, {2} duplicates'.format(scanner.processed.count - processed,
+            scanner.added.count - added, scanner.duplicate.count - duplicate))
+
+def print_stats():
+    sys.stderr.write(u'\n{0}\n'.format(config.stats.format()).encode(config.encoding, 'replace'))
+    sys.stderr.flush()
 
 def main():
     global config, log
     oparser = optparse.OptionParser(
-        usage='%prog [options] <source> <destination>',
+        usage='%prog [options] <source>... <destination>',
         version=APP_VERSION_STRING,
         prog=APP_SHORT_NAME)
 
@@ -95,20 +383,64 @@ def main():
         help="show operations log")
     oparser.add_option('', '--no-progressbar', action='store_false', dest='pbar', default=True,
         help="don't show progress bar")
+    oparser.add_option('-j', '--jobs', type='int', dest='jobs', default=1, metavar='N',
+        help='number of files hashed in parallel (%default)')
+    oparser.add_option('', '--io-workers', type='int', dest='io_workers', default=0, metavar='N',
+        help='number of threads adding files to repository, 0 to add them while scanning (%default)')
+    oparser.add_option('', '--disk-order', action='store_true', dest='disk_order', default=False,
+        help='hash files in order of their location on disk, read rotational disks with one thread (Linux)')
+    oparser.add_option('', '--hash-engine', dest='hash_engine', default=hasher.DEFAULT_ENGINE,
+        help='file hashing engine ({0}, default %default)'.format('|'.join(sorted(hasher.ENGINES))))
+    oparser.add_option('', '--no-prefilter', action='store_false', dest='prefilter', default=True,
+        help="don't compare edges of large files with repository books before hashing")
+    oparser.add_option('', '--rebuild-index', action='store_true', dest='rebuild_index', default=False,
+        help="reload library from source even if its cached index is up to date")
 
     optgroup = optparse.OptionGroup(oparser, 'File handling options')
     optgroup.add_option('-m', '--method', dest='method', default=M_COPY,
         help='file processing method ({0})'.format('|'.join(config.methods)))
     optgroup.add_option('-r', '--remove-empty', action='store_true',
-        dest='remove_empty', default=False, help='remove empty directories')
+        dest='remove_empty', default=False, help='remove empty directories (in watch mode only after first scan)')
     optgroup.add_option('', '--remove-duplicates', action='store_true',
         dest='remove_duplicates', default=False,
         help='remove files that already exist in repository')
     oparser.add_option_group(optgroup)
 
+    oparser.add_option('', '--stats-json', dest='stats_json', metavar='FILE',
+        help='write run statistics (timings, counters, memory usage) to FILE in JSON format')
+    oparser.add_option('', '--profile', dest='profile', metavar='FILE',
+        help='profile main thread and write pstats to FILE (use -j 1 --io-workers 0 to profile everything)')
+
+    optgroup = optparse.OptionGroup(oparser, 'Watch options')
+    optgroup.add_option('', '--watch', action='store_true', dest='watch', default=False,
+        help='after scanning keep running and process new files as they appear in source')
+    optgroup.add_option('', '--settle-time', type='float', dest='settle_time', default=DEFAULT_SETTLE_TIME,
+        metavar='SECONDS', help='process new file only if it has not changed for SECONDS (%default)')
+    optgroup.add_option('', '--poll', action='store_false', dest='inotify', default=True,
+        help="don't use inotify, poll source for new files periodically")
+    optgroup.add_option('', '--poll-interval', type='float', dest='poll_interval', default=DEFAULT_POLL_INTERVAL,
+        metavar='SECONDS', help='interval between source polls (%default)')
+    oparser.add_option_group(optgroup)
+
+    optgroup = optparse.OptionGroup(oparser, 'Resume options')
+    optgroup.add_option('', '--journal', dest='journal', metavar='PATH',
+        help='path to journal of completed operations (~/.cache/reposeer/journal-<hash>.log)')
+    optgroup.add_option('', '--resume', action='store_true', dest='resume', default=False,
+        help="skip files processed by interrupted run")
+    oparser.add_option_group(optgroup)
+
+    optgroup = optparse.OptionGroup(oparser, 'Hash cache options')
+    optgroup.add_option('', '--hash-cache', dest='hash_cache', metavar='PATH',
+        help='path to file hash cache (~/.cache/reposeer/hashes.sqlite)')
+    optgroup.add_option('', '--no-hash-cache', action='store_false', dest='use_hash_cache', default=True,
+        help="don't cache md5 hashes of scanned files")
+    oparser.add_option_group(optgroup)
+
     optgroup = optparse.OptionGroup(oparser, 'CSV options')
     optgroup.add_option('', '--csv', dest='csv', metavar='FILENAME', default='libgen.csv',
         help='path to csv (%default)')
+    optgroup.add_option('', '--csv-jobs', type='int', dest='csv_jobs', default=multiprocessing.cpu_count(),
+        metavar='N', help='number of processes parsing csv (%default)')
     oparser.add_option_group(optgroup)
 
     optgroup = optparse.OptionGroup(oparser, "DB connection options")
@@ -116,30 +448,76 @@ def main():
     optgroup.add_option('', '--db-name', default='bookwarrior', help='DB name (%default)')
     optgroup.add_option('', '--db-user', help='DB user')
     optgroup.add_option('', '--db-passwd', metavar='PASSWD', default='', help='DB password (empty)')
+    optgroup.add_option('', '--db-fetch-size', type='int', metavar='ROWS', default=loader.DB_FETCH_SIZE,
+        help='number of rows fetched from DB at once (%default)')
     oparser.add_option_group(optgroup)
 
     (options, args) = oparser.parse_args()
-    if len(args) != 2:
+    if len(args) < 2:
         oparser.error('Wrong number of arguments')
+    if options.jobs < 1:
+        oparser.error('Number of jobs must be positive')
+    if options.csv_jobs < 1:
+        oparser.error('Number of csv parsing processes must be positive')
+    if options.db_fetch_size < 1:
+        oparser.error('DB fetch size must be positive')
+    if options.settle_time < 0 or options.poll_interval <= 0:
+        oparser.error('Settle time and poll interval must be positive')
+    if options.io_workers < 0:
+        oparser.error('Number of I/O workers must not be negative')
+    if options.hash_engine not in hasher.ENGINES:
+        oparser.error(u'Unknown hashing engine "{0}"'.format(options.hash_engine))
     if options.method not in config.methods:
         oparser.error(u'Unknown file processing method "{0}"'.format(options.method))
     if config.methods[options.method] is None:
         return error(config.get_error_message(options.method))
 
-    config.src, config.dst = (os.path.abspath(arg).decode(config.encoding)
-        for arg in args)
+    if options.profile:
+        # профилируется только главный поток
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(run, options, args)
+        finally:
+            profiler.dump_stats(options.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    return run(options, args)
+
+def run(options, args):
+    ''' Обрабатывает каталоги-источники с разобранными параметрами командной строки '''
+    global config, log
 
-    if not os.path.isdir(config.src):
-        return error(u'Directory {0} not found'.format(config.src))
+    sources = [os.path.abspath(arg).decode(config.encoding) for arg in args[:-1]]
+    config.dst = os.path.abspath(args[-1]).decode(config.encoding)
+    config.hash_engine = hasher.ENGINES[options.hash_engine]
+    config.repository = RepositoryIndex()
+    # md5 книги -> md5-хеш её краёв для предварительной проверки
+    config.edges_cache = {}
+    config.stats = RunStats()
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> выводит, на что уходит время
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print_stats())
+        # прерванные сигналом системные вызовы перезапускаются
+        signal.siginterrupt(signal.SIGUSR1, False)
+
+    for i, src in enumerate(sources):
+        if not os.path.isdir(src):
+            return error(u'Directory {0} not found'.format(src))
+        # файлы вложенного источника обработались бы дважды
+        for other in sources[:i]:
+            if (os.path.join(src, u'').startswith(os.path.join(other, u''))
+                or os.path.join(other, u'').startswith(os.path.join(src, u''))
+            ):
+                return error(u'Source directories {0} and {1} overlap'.format(other, src))
     if not os.path.isdir(config.dst):
         return error(u'Directory {0} not found'.format(config.dst))
 
-    if not os.access(config.src, os.R_OK):
-        return error(u'Not enough rights for reading from %s' % config.src)
-    if ((options.remove_empty or options.remove_duplicates or options.method == M_MOVE)
-        and not os.access(config.src, os.W_OK)
-    ):
-        return error(u'Not enough rights for writing to %s' % config.src)
+    for src in sources:
+        if not os.access(src, os.R_OK):
+            return error(u'Not enough rights for reading from %s' % src)
+        if ((options.remove_empty or options.remove_duplicates or options.method == M_MOVE)
+            and not os.access(src, os.W_OK)
+        ):
+            return error(u'Not enough rights for writing to %s' % src)
     if not os.access(config.dst, os.W_OK):
         return error(u'Not enough rights for writing to %s' % config.dst)
 
@@ -147,57 +525,95 @@ def main():
     # в Windows мягкие и жёсткие ссылки можно создавать только на NTFS
     # (жёсткие — только в пределах одного диска)
     if config.windows and options.method in (M_SYMLINK, M_HARDLINK):
-        message = config.checkfs(options.method)
-        if message:
-            return error(message)
+        for src in sources:
+            message = config.checkfs(options.method, src)
+            if message:
+                return error(message)
 
     if options.db_user:
-        worker = loader.DBLoader(options.db_host, options.db_name, options.db_user, options.db_passwd)
+        worker = loader.DBLoader(options.db_host, options.db_name, options.db_user, options.db_passwd,
+            options.db_fetch_size)
     else:
         if not os.path.isfile(options.csv):
             return error(u'File {0} not found'.format(options.csv))
-        worker = loader.CSVLoader(options.csv)
+        worker = loader.CSVLoader(options.csv, options.csv_jobs)
+
+    # журнал позволяет продолжить прерванный запуск, при пробном запуске не ведётся
+    journal = None
+    if not options.dry_run:
+        try:
+            journal_path = options.journal or os.path.join(cache_dir(), 'journal-{0}.log'.format(
+                hashlib.md5(u'\n'.join(sources + [config.dst]).encode('utf-8')).hexdigest()[:16]))
+        except OSError, ex:
+            return error(u'Unable to create cache directory: {0!s}'.format(ex))
+        journal = Journal(journal_path, options.resume)
+
+    hash_cache = None
+    if options.use_hash_cache:
+        try:
+            hash_cache_path = options.hash_cache or os.path.join(cache_dir(), 'hashes.sqlite')
+        except OSError, ex:
+            return error(u'Unable to create cache directory: {0!s}'.format(ex))
+        hash_cache = HashCache(hash_cache_path)
 
     print('Loading Library Genesis...')
-    library = worker.load(options.pbar)
-    library_filesizes = set(value[1] for value in library.values())
+    with config.stats.phase('load'):
+        library = worker.load(options.pbar, options.rebuild_index)
+    config.stats.add('books_loaded', len(library))
     print('{0} books loaded'.format(len(library)))
 
+    watcher = None
+    if options.watch:
+        # наблюдение начинается до обхода, чтобы не пропустить файлы, появившиеся во время первого прохода
+        watcher = Watcher(sources, options.settle_time, options.poll_interval, options.inotify)
+
     print('Analyzing total size of files for processing...', end=' ')
-    src_size = dirsize(config.src)
+    # дерево обходится один раз, собранные размеры используются при сканировании
+    with config.stats.phase('walk'):
+        src_trees, src_size = scan_sources(sources)
     print(bytes_to_human(src_size))
     print('Scanning...')
 
-    processed, added, duplicate = ProgressCounter(), ProgressCounter(), ProgressCounter()
-    pbar = ProgressBar(maxval=src_size, displaysize=True, enabled=options.pbar)
+    scanner = Scanner(library, hash_cache, journal, options)
+    for src_tree in src_trees:
+        for path, records, entries in src_tree:
+            scanner.remaining[path] = entries
+    src_groups = scanner.schedule(records for src_tree in src_trees for path, records, entries in src_tree)
+    pbar = ProgressBar(maxval=src_size, displaysize=True, displayfiles=True, enabled=options.pbar)
     log.set_pbar(pbar)
-    delta = src_size / CHECK_PROGRESS_DIVIDER
-    for path, dirs, files in os.walk(config.src):
-        for file in files:
-            fullpath = os.path.join(path, file)
-            filesize = os.path.getsize(fullpath)
-
-            # если в базе есть файл такого размера
-            if filesize in library_filesizes:
-                md5 = md5hash(fullpath)
-                # и совпал по хешу
-                if md5 in library:
-                    # то обрабатываем его
-                    already_in_repo = process(fullpath, library[md5][0], options)
-                    if already_in_repo:
-                        duplicate.add(filesize)
-                    else:
-                        added.add(filesize)
-
-            processed.add(filesize)
-            # будем обновлять, только если накопилось достаточно файлов
-            if processed.size - pbar.curval >= delta:
-                pbar.set(processed.size)
-        if not options.dry_run and options.remove_empty and dirsize(path) == 0:
-            shutil.rmtree(path)
-
-    pbar.finish()
-    log.unset_pbar()
+
+    completed = False
+    try:
+        with config.stats.phase('scan'):
+            scanner.scan(src_groups, pbar)
+        pbar.stop()
+
+        if not options.dry_run and options.remove_empty:
+            with config.stats.phase('cleanup'):
+                for src_tree in src_trees:
+                    remove_empty_dirs(src_tree, scanner.remaining, options)
+
+        pbar.finish()
+        log.unset_pbar()
+        if watcher is not None:
+            watch(watcher, scanner, options)
+        completed = True
+    finally:
+        # сохраняем посчитанные хеши и журнал, даже если сканирование прервано
+        pbar.stop()
+        if watcher is not None:
+            watcher.close()
+        if hash_cache is not None:
+            hash_cache.close()
+        if journal is not None:
+            # журнал завершённого запуска не нужен
+            journal.close(remove=completed)
+
+    processed, added, duplicate = scanner.processed, scanner.added, scanner.duplicate
+    prefiltered, resumed = scanner.prefiltered, scanner.resumed
+    # проверка читает края и файлов источника, и книг в репозитории, это вычитается из экономии
+    prefilter_read = config.stats.counters.get('prefilter_bytes_read', 0)
+    prefilter_saved = prefiltered.size - prefilter_read
 
     print('Processed: {0} ({1})'.format(
         processed.count, bytes_to_human(processed.size)))
@@ -206,10 +622,64 @@ def main():
     print('Duplicates {0}: {1} ({2})'.format(
         'removed' if options.remove_duplicates else 'found',
         duplicate.count, bytes_to_human(duplicate.size)))
+    if options.method == M_AUTO and added.count:
+        print('Copying methods: {0}'.format(', '.join(
+            '{0} {1}'.format(method, config.copier.counts[method])
+            for method in fastcopy.METHODS if config.copier.counts[method])))
+    if resumed.count:
+        print('Processed by interrupted run: {0} ({1})'.format(
+            resumed.count, bytes_to_human(resumed.size)))
+    if prefilter_saved > 0:
+        print('Skipped by prefilter: {0} (saved reading {1})'.format(
+            prefiltered.count, bytes_to_human(prefilter_saved)))
+    elif prefilter_read:
+        print('Skipped by prefilter: {0} (read {1} more than without it)'.format(
+            prefiltered.count, bytes_to_human(-prefilter_saved)))
+
+    if options.stats_json:
+        counter = lambda counter: {'files': counter.count, 'bytes': counter.size}
+        config.stats.save(options.stats_json,
+            options={
+                'method': options.method,
+                'jobs': options.jobs,
+                'io_workers': options.io_workers,
+                'hash_engine': options.hash_engine,
+                'disk_order': options.disk_order,
+                'prefilter': options.prefilter,
+                'dry_run': options.dry_run,
+            },
+            library={
+                'books': len(library),
+                'loaded_from': worker.loaded_from,
+            },
+            source={
+                'sources': len(sources),
+                'devices': len(src_groups),
+                'dirs': sum(len(src_tree) for src_tree in src_trees),
+                'files': sum(len(records) for src_tree in src_trees for path, records, entries in src_tree),
+                'bytes': src_size,
+            },
+            results={
+                'processed': counter(processed),
+                'added': counter(added),
+                'duplicates': counter(duplicate),
+                'resumed': counter(resumed),
+                'prefiltered': counter(prefiltered),
+                'prefilter_saved_bytes': prefilter_saved,
+            },
+            copying_methods=config.copier.counts if options.method == M_AUTO else None,
+            hash_cache=None if hash_cache is None else {
+                'hits': hash_cache.hits,
+                'misses': hash_cache.misses,
+                'hit_rate': hit_rate(hash_cache.hits, hash_cache.misses),
+            },
+        )
 
     return 0
 
 if __name__ == '__main__':
+    # в собранной PyInstaller'ом программе процессы разбора csv запускают её же
+    multiprocessing.freeze_support()
     try:
         logging.basicConfig(level=logging.INFO)
         log = ProgressBarSafeLogger(logging.getLogger())
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Run statistics: wall clock and CPU time of sequential phases, busy time of work
+    done in worker threads (summed over threads), counters, peak memory and I/O usage.
+'''
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+
+from common import ReposeerException, bytes_to_human
+
+
+def cpu_time():
+    'User and system CPU time of the process, all threads included.'
+    times = os.times()
+    return times[0] + times[1]
+
+def peak_rss():
+    'Peak resident set size in bytes or None if platform does not report it.'
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere except Mac OS X
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def process_io():
+    '''
+        I/O counters of the process from /proc/self/io (Linux): read and write syscalls,
+        bytes passed to them and bytes actually fetched from or sent to storage.
+        Returns None if they are not available.
+    '''
+    try:
+        with open('/proc/self/io') as fobj:
+            return dict((name, int(value)) for name, value in
+                (line.split(':', 1) for line in fobj if ':' in line))
+    except (IOError, ValueError):
+        return None
+
+def hit_rate(hits, misses):
+    'Share of hits or None if there were no lookups.'
+    total = hits + misses
+    return float(hits) / total if total else None
+
+
+class RunStats(object):
+    '''
+        Collects statistics of a run and saves them as JSON.
+        Counters and busy timers can be updated from several threads.
+    '''
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.busy = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        # SIGUSR1 handler calls format() in main thread, which can be holding the lock already
+        self._lock = threading.RLock()
+        self._started = time.time()
+        self._started_cpu = cpu_time()
+        # (name, start time) of running phase
+        self._current = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        'Measures wall clock and CPU time of sequential phase.'
+        wall, cpu = time.time(), cpu_time()
+        outer, self._current = self._current, (name, wall)
+        try:
+            yield
+        finally:
+            self._current = outer
+            entry = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            entry['wall'] += time.time() - wall
+            entry['cpu'] += cpu_time() - cpu
+
+    @contextlib.contextmanager
+    def timer(self, name, size=0):
+        'Measures time of one operation done by one of the threads.'
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                entry = self.busy.get(name)
+                if entry is None:
+                    entry = self.busy[name] = {'seconds': 0.0, 'operations': 0, 'bytes': 0}
+                entry['seconds'] += elapsed
+                entry['operations'] += 1
+                entry['bytes'] += size
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def format(self):
+        'Returns human readable breakdown of the run so far.'
+        now = time.time()
+        lines = [u'Elapsed {0:.1f} s, CPU {1:.1f} s'.format(now - self._started, cpu_time() - self._started_cpu)]
+        for name, entry in self.phases.items():
+            lines.append(u'  {0}: {1:.1f} s, CPU {2:.1f} s'.format(name, entry['wall'], entry['cpu']))
+        current = self._current
+        if current is not None:
+            lines.append(u'  {0}: {1:.1f} s so far'.format(current[0], now - current[1]))
+        with self._lock:
+            busy = [(name, dict(entry)) for name, entry in self.busy.items()]
+            counters = self.counters.items()
+        for name, entry in busy:
+            line = u'  {0}: {1} in {2:.1f} s of threads time'.format(name, entry['operations'], entry['seconds'])
+            if entry['bytes'] and entry['seconds'] > 0:
+                line += u', {0}/s'.format(bytes_to_human(entry['bytes'] / entry['seconds']))
+            lines.append(line)
+        for name, value in counters:
+            lines.append(u'  {0}: {1}'.format(name, value))
+        rss = peak_rss()
+        if rss is not None:
+            lines.append(u'  peak memory: {0}'.format(bytes_to_human(rss)))
+        return u'\n'.join(lines)
+
+    def report(self, **sections):
+        'Returns statistics as a dict, extra sections are added as is.'
+        busy = collections.OrderedDict()
+        for name, entry in self.busy.items():
+            entry = dict(entry)
+            if entry['seconds'] > 0:
+                entry['operations_per_second'] = entry['operations'] / entry['seconds']
+                if entry['bytes']:
+                    entry['bytes_per_second'] = entry['bytes'] / entry['seconds']
+            busy[name] = entry
+        result = collections.OrderedDict([
+            ('started', self._started),
+            ('wall', time.time() - self._started),
+            ('cpu', cpu_time() - self._started_cpu),
+            ('phases', self.phases),
+            ('busy', busy),
+            ('counters', self.counters),
+            ('peak_rss', peak_rss()),
+            ('io', process_io()),
+        ])
+        result.update(sorted(sections.items()))
+        return result
+
+    def save(self, path, **sections):
+        try:
+            with open(path, 'wb') as fobj:
+                json.dump(self.report(**sections), fobj, indent=2)
+                fobj.write('\n')
+        except IOError, ex:
+            raise ReposeerException(u'Unable to write statistics to {0}: {1!s}'.format(path, ex))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import struct
+import collections
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class FileRecord(collections.namedtuple('FileRecord', 'path size dev inode mtime')):
+    'Regular file found by walk(). Modification time is in nanoseconds.'
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, path, st):
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 10 ** 9)
+        return cls(path, st.st_size, st.st_dev, st.st_ino, mtime)
+
+
+def stat_file(path):
+    return FileRecord.from_stat(path, os.stat(path))
+
+
+class PackedRecords(object):
+    '''
+        FileRecords of one directory in compact form: names joined into one utf-8 string and numbers
+        packed into one byte string, so big trees can be kept in memory.
+        Records are created again when iterated over.
+    '''
+    __slots__ = ('dirpath', '_names', '_data')
+    # size, device, inode, modification time
+    FORMAT = struct.Struct('<qQQq')
+
+    def __init__(self, dirpath, records):
+        self.dirpath = dirpath
+        self._names = u'\0'.join(os.path.basename(record.path) for record in records).encode('utf-8')
+        self._data = ''.join(self.FORMAT.pack(record.size, record.dev, record.inode, record.mtime)
+            for record in records)
+
+    def __len__(self):
+        return len(self._data) // self.FORMAT.size
+
+    def __iter__(self):
+        if not self._data:
+            return
+        for i, name in enumerate(self._names.split('\0')):
+            size, dev, inode, mtime = self.FORMAT.unpack_from(self._data, i * self.FORMAT.size)
+            yield FileRecord(os.path.join(self.dirpath, name.decode('utf-8')), size, dev, inode, mtime)
+
+def _scan_scandir(path):
+    dirs, files, others = [], [], 0
+    for entry in scandir(path):
+        try:
+            # DirEntry caches stat data, symlinks are never followed
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(FileRecord.from_stat(entry.path, entry.stat(follow_symlinks=False)))
+            else:
+                others += 1
+        except OSError:
+            # entry was removed during walk
+            pass
+    return dirs, files, others
+
+def _scan_listdir(path):
+    dirs, files, others = [], [], 0
+    for name in os.listdir(path):
+        fullpath = os.path.join(path, name)
+        try:
+            st = os.lstat(fullpath)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(name)
+        elif stat.S_ISREG(st.st_mode):
+            files.append(FileRecord.from_stat(fullpath, st))
+        else:
+            others += 1
+    return dirs, files, others
+
+_scan = _scan_scandir if scandir is not None else _scan_listdir
+
+def walk(top):
+    '''
+        Top-down directory tree generator like os.walk(), but stats every entry only once.
+        Yields (dirpath, dirnames, files, others) tuples, where files is a list of FileRecord
+        for regular files and others is a number of skipped entries (symbolic links, special files).
+        Symbolic links are never followed. Like in os.walk(), caller can modify dirnames
+        to prune the walk, and unreadable directories are skipped.
+    '''
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            dirs, files, others = _scan(path)
+        except OSError:
+            continue
+        yield path, dirs, files, others
+        stack.extend(os.path.join(path, name) for name in reversed(dirs))
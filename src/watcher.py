@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Watching directory trees for new files.
+    Linux inotify is used when it is available, otherwise the tree is polled periodically.
+    Files are reported only after they haven't changed for settle time,
+    so partially written files are not processed.
+'''
+
+import os
+import sys
+import stat
+import time
+import errno
+import select
+import struct
+
+from walker import walk, FileRecord
+from common import LINUX, libc_function
+
+DEFAULT_SETTLE_TIME = 2.0
+DEFAULT_POLL_INTERVAL = 10.0
+
+M_INOTIFY = 'inotify'
+M_POLLING = 'polling'
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# wd, mask, cookie, length of name
+EVENT_FORMAT = struct.Struct('iIII')
+READ_SIZE = 2 ** 16
+
+
+def _load_inotify():
+    'Returns inotify_init1() and inotify_add_watch() of C library, raises OSError if there are none.'
+    import ctypes
+    init = libc_function('inotify_init1', (ctypes.c_int,))
+    add_watch = libc_function('inotify_add_watch', (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32))
+    if init is None or add_watch is None:
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    return init, add_watch
+
+
+class InotifySource(object):
+    '''
+        Reports files closed after writing, created or moved into the trees.
+        New subdirectories are watched as soon as they appear.
+    '''
+    method = M_INOTIFY
+
+    def __init__(self, tops):
+        self._tops = tops
+        self._encoding = sys.getfilesystemencoding() or 'utf-8'
+        init, self._add_watch = _load_inotify()
+        self._fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        # watch descriptor -> directory path
+        self._wds = {}
+        # files found in new directories
+        self._found = []
+        try:
+            for top in tops:
+                self._add_tree(top, report=False)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, top, report):
+        for dirpath, dirs, files, others in walk(top):
+            try:
+                wd = self._add_watch(self._fd, dirpath.encode(self._encoding), WATCH_MASK)
+            except OSError, ex:
+                if ex.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # directory was removed
+                    continue
+                # e.g. ENOSPC when there are too many watches
+                raise
+            self._wds[wd] = dirpath
+            if report:
+                # files could be written before directory was watched
+                self._found.extend(record.path for record in files)
+
+    def read(self, timeout):
+        'Returns paths of changed files, waiting for them not longer than timeout seconds.'
+        if self._found:
+            timeout = 0
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error, ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            # interrupted by signal, caller decides whether to wait more
+            readable = []
+        if readable:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except OSError, ex:
+                if ex.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                data = ''
+            self._parse(data)
+        paths, self._found = self._found, []
+        return paths
+
+    def _parse(self, data):
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_FORMAT.unpack_from(data, pos)
+            pos += EVENT_FORMAT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, look at the whole trees again
+                for top in self._tops:
+                    self._add_tree(top, report=True)
+                continue
+            if mask & IN_IGNORED:
+                # directory was removed
+                self._wds.pop(wd, None)
+                continue
+            dirpath = self._wds.get(wd)
+            if dirpath is None or not name:
+                continue
+            try:
+                path = os.path.join(dirpath, name.decode(self._encoding))
+            except UnicodeDecodeError:
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path, report=True)
+            else:
+                self._found.append(path)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PollingSource(object):
+    'Reports new and changed files by walking the trees every interval seconds.'
+    method = M_POLLING
+
+    def __init__(self, tops, interval):
+        self._tops = tops
+        self._interval = interval
+        self._snapshot = self._scan()
+        self._next = time.time() + interval
+
+    def _scan(self):
+        return dict((record.path, (record.size, record.mtime))
+            for top in self._tops for dirpath, dirs, files, others in walk(top) for record in files)
+
+    def read(self, timeout):
+        'Returns paths of changed files, waiting for them not longer than timeout seconds.'
+        left = self._next - time.time()
+        if left > 0:
+            time.sleep(min(timeout, left))
+            if time.time() < self._next:
+                return []
+        snapshot = self._scan()
+        self._next = time.time() + self._interval
+        changed = [path for path, signature in snapshot.iteritems()
+            if self._snapshot.get(path) != signature]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    '''
+        Reports regular files which appeared or changed in directory trees after watcher was created.
+        File is reported when its size and modification time haven't changed for settle_time seconds.
+    '''
+    def __init__(self, tops, settle_time=DEFAULT_SETTLE_TIME, poll_interval=DEFAULT_POLL_INTERVAL,
+        use_inotify=True
+    ):
+        self.settle_time = settle_time
+        self.source = None
+        if use_inotify and LINUX:
+            try:
+                self.source = InotifySource(tops)
+            except OSError:
+                # no inotify or too many directories for it
+                pass
+        if self.source is None:
+            self.source = PollingSource(tops, poll_interval)
+        self.method = self.source.method
+        # path -> ((size, mtime) or None if file is not accessible, time of last change)
+        self._pending = {}
+
+    def wait(self, timeout):
+        'Returns list of walker.FileRecord of settled files, waiting for them not longer than timeout seconds.'
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            left = deadline - now
+            if self._pending:
+                first = min(changed for signature, changed in self._pending.itervalues())
+                left = min(left, first + self.settle_time - now)
+            for path in self.source.read(max(left, 0)):
+                self._pending[path] = (self._signature(path), time.time())
+            ready = self._settled()
+            if ready or time.time() >= deadline:
+                return ready
+
+    def _signature(self, path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return FileRecord.from_stat(path, st)
+
+    def _settled(self):
+        now = time.time()
+        ready = []
+        for path, (record, changed) in self._pending.items():
+            if now - changed < self.settle_time:
+                continue
+            current = self._signature(path)
+            if current is None:
+                # file was removed or it isn't a regular file
+                del self._pending[path]
+            elif record is None or (current.size, current.mtime) != (record.size, record.mtime):
+                # file is still being written
+                self._pending[path] = (current, now)
+            else:
+                del self._pending[path]
+                ready.append(current)
+        return ready
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Tests of DBLoader against a local stand-in for MySQL: fake MySQLdb module
+    which runs queries on SQLite database with the same "updated" table.
+'''
+
+import os
+import sys
+import types
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+
+class FakeCursor(object):
+    def __init__(self, conn, server_side):
+        self._cursor = conn.cursor()
+        self.server_side = server_side
+        self.fetch_sizes = []
+        self.fetched = 0
+
+    def execute(self, query, params=None):
+        self._cursor.execute(query.replace('%s', '?'), params or ())
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows = self._cursor.fetchmany(size)
+        self.fetched += len(rows)
+        return rows
+
+    def fetchall(self):
+        raise AssertionError('rows must be streamed with fetchmany()')
+
+    def close(self):
+        self._cursor.close()
+
+
+class FakeConnection(object):
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self.cursors = []
+
+    def cursor(self, cursorclass=None):
+        cursor = FakeCursor(self._conn, cursorclass is FakeMySQLdb.cursors.SSCursor)
+        self.cursors.append(cursor)
+        return cursor
+
+    def close(self):
+        self._conn.close()
+
+
+# module replacing MySQLdb, database path is set by tests
+FakeMySQLdb = types.ModuleType('MySQLdb')
+FakeMySQLdb.cursors = types.ModuleType('MySQLdb.cursors')
+FakeMySQLdb.cursors.SSCursor = type('SSCursor', (object, ), {})
+FakeMySQLdb.OperationalError = type('OperationalError', (Exception, ), {})
+FakeMySQLdb.path = None
+FakeMySQLdb.connections = []
+
+def fake_connect(**kw):
+    conn = FakeConnection(FakeMySQLdb.path)
+    FakeMySQLdb.connections.append(conn)
+    return conn
+
+FakeMySQLdb.connect = fake_connect
+sys.modules['MySQLdb'] = FakeMySQLdb
+sys.modules['MySQLdb.cursors'] = FakeMySQLdb.cursors
+
+import loader
+
+
+def md5(value):
+    return hashlib.md5(value).hexdigest()
+
+
+class DBLoaderTest(unittest.TestCase):
+    ROWS = 25
+    FETCH_SIZE = 7
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmpdir, 'cache')
+        FakeMySQLdb.path = os.path.join(self.tmpdir, 'library.sqlite')
+        self.db = sqlite3.connect(FakeMySQLdb.path)
+        self.db.execute('CREATE TABLE updated (ID INTEGER PRIMARY KEY, Filename TEXT, Filesize INTEGER, '
+            'MD5 TEXT, TimeLastModified TEXT)')
+        self.db.executemany('INSERT INTO updated VALUES (?, ?, ?, ?, ?)',
+            [(i + 1, u'{0}/book{1}.pdf'.format(i // 10 * 10, i), 1000 + i, md5(str(i)),
+                '2011-01-01 00:00:{0:02}'.format(i)) for i in xrange(self.ROWS)])
+        # rows without file names are not books
+        self.db.execute("INSERT INTO updated VALUES (100, '', 1, ?, '2011-01-01 00:00:00')", (md5('empty'), ))
+        self.db.commit()
+        del FakeMySQLdb.connections[:]
+
+    def tearDown(self):
+        self.db.close()
+        if self.environ is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.environ
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, rebuild_index=False):
+        worker = loader.DBLoader('localhost', 'bookwarrior', 'user', '', self.FETCH_SIZE)
+        return worker, worker.load(False, rebuild_index)
+
+    def fetch_cursors(self):
+        return [cursor for conn in FakeMySQLdb.connections for cursor in conn.cursors if cursor.fetch_sizes]
+
+    def test_load_from_source(self):
+        worker, library = self.load()
+        self.assertEqual(worker.loaded_from, loader.L_SOURCE)
+        self.assertEqual(worker.count, self.ROWS)
+        self.assertEqual(len(library), self.ROWS)
+        self.assertEqual(library.get(md5('3')), (u'0/book3.pdf', 1003))
+        self.assertEqual(library.get(md5('empty')), None)
+        cursors = self.fetch_cursors()
+        self.assertEqual(len(cursors), 1)
+        self.assertTrue(cursors[0].server_side)
+        # 25 rows by 7 and the empty fetch at the end
+        self.assertEqual(cursors[0].fetched, self.ROWS)
+        self.assertEqual(cursors[0].fetch_sizes, [self.FETCH_SIZE] * 5)
+        library.close()
+
+    def test_update_and_index(self):
+        self.load()[1].close()
+        self.db.execute("INSERT INTO updated VALUES (?, 'new/book.pdf', 5, ?, '2011-01-02 00:00:00')",
+            (self.ROWS + 1, md5('new')))
+        self.db.execute("UPDATE updated SET Filename = 'renamed.pdf', TimeLastModified = '2011-01-03 00:00:00' "
+            "WHERE ID = 3")
+        self.db.commit()
+        del FakeMySQLdb.connections[:]
+
+        worker, library = self.load()
+        self.assertEqual(worker.loaded_from, loader.L_UPDATE)
+        self.assertEqual(len(library), self.ROWS + 1)
+        self.assertEqual(library.get(md5('new')), (u'new/book.pdf', 5))
+        self.assertEqual(library.get(md5('2')), (u'renamed.pdf', 1002))
+        self.assertEqual(library.get(md5('4')), (u'0/book4.pdf', 1004))
+        # only the added and the modified rows are fetched,
+        # and the last modified one again, since modification time has one second precision
+        cursors = self.fetch_cursors()
+        self.assertEqual(len(cursors), 1)
+        self.assertTrue(cursors[0].server_side)
+        self.assertEqual(cursors[0].fetched, 3)
+        library.close()
+
+        del FakeMySQLdb.connections[:]
+        worker, library = self.load()
+        self.assertEqual(worker.loaded_from, loader.L_INDEX)
+        self.assertEqual(len(library), self.ROWS + 1)
+        self.assertEqual(library.get(md5('2')), (u'renamed.pdf', 1002))
+        self.assertEqual(self.fetch_cursors(), [])
+        library.close()
+
+    def test_rebuild_index(self):
+        self.load()[1].close()
+        worker, library = self.load(rebuild_index=True)
+        self.assertEqual(worker.loaded_from, loader.L_SOURCE)
+        self.assertEqual(len(library), self.ROWS)
+        library.close()
+
+
+if __name__ == '__main__':
+    unittest.main()